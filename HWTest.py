@@ -14,16 +14,45 @@ Could be made more generic via config files.
 import os
 import sys
 import time
+import atexit
 import glob
+import imp
+import gzip
+import json
+import errno
+import fcntl
+import select
+import struct
 import subprocess
-from math import sin, cos, pi
+import threading
+import wave
+import audioop
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from math import sin, cos, pi, ceil, log10, sqrt
+from optparse import OptionParser
 
 import pygame
 import pygame.locals
 
+# NumPy takes long to import from SD card, so only look for it here and
+# import it when first needed (generated test tones)
+try:
+    imp.find_module('numpy')
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False  # no generated test tones, the WAV files still work
+
 DEBUG = False
 no_secs = False
 
+LOG_FILE = None  # None: stdout, see --log
+LOG_MAX_BYTES = 256 * 1024  # LOG_FILE is rotated at this size
+LOG_BACKUPS = 2  # LOG_FILE.1 .. LOG_FILE.N kept
+LOG_FLUSH_SECS = 2.0  # written in batches at most this often, sooner for errors
+LOG_REPEAT_SECS = 10.0  # identical events within this are only counted
+
 
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -34,6 +63,236 @@ BLUE = (0, 0, 255)
 PRESSED_DONE = BLUE
 PRESSED_ACTIVE = GREEN
 BOX_OUTLINE = WHITE
+SAMPLE_TRAIL = (128, 0, 0)
+
+
+class EventLog(object):
+    """Structured log, written by a background thread in batches.
+
+    log.info/warning/error(event, **fields) only queue a record, one
+    line per record "time LEVEL event key=value ..." is written later,
+    at most LOG_FLUSH_SECS after it was queued, or as soon as an error
+    is queued, so the frame loops never wait for the SD card.  The
+    writer sleeps in select() on a wake up pipe, Event.wait(timeout)
+    would poll every 50 ms on Python 2.  An event repeating with the same
+    fields within LOG_REPEAT_SECS is not queued again, a single record
+    with repeated=N follows once the window is over.  LOG_FILE is
+    rotated at LOG_MAX_BYTES, stdout is never rotated.
+    """
+
+    batch = 100  # queued records that wake the writer early
+
+    def __init__(self):
+        # the real clock, a replayed session must not see these reads
+        self.clock = time.time
+        self.queue = deque()
+        self.repeats = {}  # (level, event, fields) -> [first time, count]
+        self.lock = threading.Lock()  # queue and repeats
+        self.writing = threading.Lock()  # the file
+        self.wake_fds = None  # (read, write) pipe, see wake()
+        self.thread = None
+        self.f = None
+        self.filename = None
+        self.size = 0
+        self.dropped = 0  # records lost to write errors
+
+    def open(self, filename=None):
+        """Log to filename (appending) instead of stdout"""
+        self.flush()
+        if self.f:
+            self.f.close()
+            self.f = None
+        self.filename = filename
+        if filename:
+            self.f = open(filename, 'a')
+            self.size = self.f.tell()
+
+    def info(self, event, **fields):
+        self.log('INFO', event, fields)
+
+    def warning(self, event, **fields):
+        self.log('WARNING', event, fields)
+
+    def error(self, event, **fields):
+        self.log('ERROR', event, fields)
+
+    def log(self, level, event, fields):
+        now = self.clock()
+        fields = tuple(sorted(fields.items()))
+        key = (level, event, fields)
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.wake_fds = os.pipe()
+                fcntl.fcntl(self.wake_fds[1], fcntl.F_SETFL, os.O_NONBLOCK)
+                self.thread = threading.Thread(target=self.run, name='EventLog')
+                self.thread.daemon = True
+                self.thread.start()
+            repeat = self.repeats.get(key)
+            if repeat and now - repeat[0] < LOG_REPEAT_SECS:
+                repeat[1] += 1
+                if repeat[1] == 1:
+                    self.wake('q')  # its repeated=N record is due when the window ends
+                return
+            self.repeats[key] = [now, 0]
+            self.queue.append((now, level, event, fields))
+            if level == 'ERROR' or len(self.queue) >= self.batch:
+                self.wake('f')
+            elif len(self.queue) == 1:
+                self.wake('q')
+        finally:
+            self.lock.release()
+
+    def wake(self, reason):
+        """Wake the writer, 'f' to write now, 'q' to (re)start the
+        LOG_FLUSH_SECS countdown for what was just queued"""
+        try:
+            os.write(self.wake_fds[1], reason)
+        except OSError:
+            pass  # pipe full, the writer has plenty to wake up for
+
+    def due(self):
+        """Seconds until something queued must be written, None if
+        nothing is waiting"""
+        self.lock.acquire()
+        try:
+            deadlines = [first + LOG_REPEAT_SECS for first, count in self.repeats.values() if count]
+            if self.queue:
+                deadlines.append(self.queue[0][0] + LOG_FLUSH_SECS)
+        finally:
+            self.lock.release()
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - self.clock())
+
+    def expire_repeats(self, now, everything=False):
+        """Queue repeated=N records for repeat windows that are over"""
+        self.lock.acquire()
+        try:
+            for key, (first, count) in self.repeats.items():
+                if everything or now - first >= LOG_REPEAT_SECS:
+                    del self.repeats[key]
+                    if count:
+                        level, event, fields = key
+                        self.queue.append((now, level, event, fields + (('repeated', count),)))
+        finally:
+            self.lock.release()
+
+    def format(self, record):
+        now, level, event, fields = record
+        line = '%s.%03d %-7s %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)), int(now * 1000) % 1000, level, event)
+        for name, value in fields:
+            if isinstance(value, float):
+                value = '%.3f' % value
+            elif isinstance(value, basestring):
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                if not value or ' ' in value or '"' in value or '=' in value:
+                    value = json.dumps(value)
+            line += ' %s=%s' % (name, value)
+        return line + '\n'
+
+    def flush(self, everything=False):
+        """Write whatever is queued, in one write()"""
+        self.writing.acquire()
+        try:
+            self.expire_repeats(self.clock(), everything)
+            lines = []
+            while True:
+                try:
+                    lines.append(self.format(self.queue.popleft()))
+                except IndexError:
+                    break
+            if not lines:
+                return
+            data = ''.join(lines)
+            try:
+                if self.f:
+                    if self.size and self.size + len(data) > LOG_MAX_BYTES:
+                        self.rotate()
+                    self.f.write(data)
+                    self.f.flush()
+                    self.size += len(data)
+                else:
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+            except (IOError, OSError, ValueError):
+                self.dropped += len(lines)  # card full or gone, nothing better to do
+        finally:
+            self.writing.release()
+
+    def rotate(self):
+        self.f.close()
+        for n in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.filename, n)):
+                os.rename('%s.%d' % (self.filename, n), '%s.%d' % (self.filename, n + 1))
+        if LOG_BACKUPS:
+            os.rename(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self.f = open(self.filename, 'w')
+        self.size = 0
+
+    def run(self):
+        while True:
+            readable = select.select([self.wake_fds[0]], [], [], self.due())[0]
+            if not readable or 'f' in os.read(self.wake_fds[0], 512):
+                self.flush()
+
+    def close(self):
+        """Write everything, pending repeat counts too"""
+        self.flush(everything=True)
+        self.writing.acquire()
+        try:
+            if self.f:
+                self.f.close()
+                self.f = None
+        finally:
+            self.writing.release()
+
+log = EventLog()
+atexit.register(log.close)
+
+
+def process_start_time():
+    """Wall clock time this process started (clock tick resolution), so
+    the start up timeline includes interpreter start and imports"""
+    try:
+        f = open('/proc/self/stat')
+        stat = f.read()
+        f.close()
+        f = open('/proc/uptime')
+        uptime = float(f.read().split()[0])
+        f.close()
+    except IOError:
+        return None
+    # starttime is field 22, count from the ')' ending the command name (field 2)
+    starttime = float(stat[stat.rindex(')') + 2:].split()[22 - 3])
+    return time.time() - uptime + starttime / os.sysconf('SC_CLK_TCK')
+
+
+class StartupTimeline(object):
+    """Logs how long each start up phase took, one STARTUP line per
+    phase, so cold start time can be tracked from release to release.
+    Nothing is logged while a SessionReplay is installed."""
+
+    def __init__(self, start=None):
+        self.start = self.last = start or time.time()
+        self.phases = []  # (phase, secs taken, secs since start)
+
+    def mark(self, phase, began=None):
+        """Phase just finished, it began at time began, default the
+        previous mark (lazily run phases pass their own)"""
+        now = time.time()  # read while replaying too, the session expects it
+        if isinstance(session, SessionReplay):
+            return  # recorded times, against this process's start they mean nothing
+        if began is None:
+            began = self.last
+        self.phases.append((phase, now - began, now - self.start))
+        log.info('startup', phase=phase, ms=(now - began) * 1000, at_ms=(now - self.start) * 1000)
+        self.last = now
+
+startup = StartupTimeline(process_start_time())
 
 
 class TextRectException(Exception):
@@ -45,6 +304,83 @@ class TextRectException(Exception):
         return self.message
 
 
+class TextLayout(object):
+    """Word wrap cache for render_textrect().
+
+    Word widths are measured once per font and line breaks are kept per
+    (font, text, width), so re-rendering an unchanged string costs no
+    font.size() calls at all and a changed one only measures new words.
+    """
+
+    def __init__(self, maxsize=32, max_words=4096):
+        self.maxsize = maxsize
+        self.max_words = max_words
+        self.widths = {}  # (font, word) -> width in pixels
+        self.layouts = OrderedDict()  # (font, text, width) -> list of lines
+        self.surfaces = {}  # rect size -> (render key, reusable surface)
+
+    def word_width(self, font, word):
+        key = (font, word)
+        try:
+            return self.widths[key]
+        except KeyError:
+            if len(self.widths) >= self.max_words:
+                self.widths.clear()
+            width = self.widths[key] = font.size(word)[0]
+            return width
+
+    def wrap(self, string, font, width):
+        """Returns list of lines that fit within width"""
+        key = (font, string, width)
+        try:
+            lines = self.layouts.pop(key)
+        except KeyError:
+            lines = self._wrap(string, font, width)
+            if len(self.layouts) >= self.maxsize:
+                self.layouts.popitem(last=False)
+        self.layouts[key] = lines
+        return lines
+
+    def _wrap(self, string, font, width):
+        final_lines = []
+        for requested_line in string.splitlines():
+            if self.word_width(font, requested_line) > width:
+                words = requested_line.split(' ')
+                # if any of our words are too long to fit, return.
+                for word in words:
+                    if self.word_width(font, word) >= width:
+                        raise TextRectException("The word " + word + " is too long to fit in the rect passed.")
+                # Start a new line, build it while the words fit.
+                # Widths are summed per word (with trailing space) rather
+                # than re-measuring the growing line each time.
+                accumulated_line = ""
+                accumulated_width = 0
+                for word in words:
+                    word_width = self.word_width(font, word + " ")
+                    if accumulated_width + word_width < width:
+                        accumulated_line += word + " "
+                        accumulated_width += word_width
+                    else:
+                        final_lines.append(accumulated_line)
+                        accumulated_line = word + " "
+                        accumulated_width = word_width
+                final_lines.append(accumulated_line)
+            else:
+                final_lines.append(requested_line)
+        return final_lines
+
+    def get_surface(self, size, key):
+        """Returns (surface, up_to_date) reusable surface for rect size"""
+        try:
+            last_key, surface = self.surfaces[size]
+        except KeyError:
+            last_key, surface = None, pygame.Surface(size)
+        self.surfaces[size] = (key, surface)
+        return surface, last_key == key
+
+text_layout = TextLayout()
+
+
 def render_textrect(string, font, rect, text_color, background_color=None, justification=0, surface=None):
     """Returns a surface containing the passed text string, reformatted
     to fit within the given rect, word-wrapping as necessary. The text
@@ -61,6 +397,9 @@ def render_textrect(string, font, rect, text_color, background_color=None, justi
     justification - 0 (default) left-justified
                     1 horizontally centered
                     2 right-justified
+    surface - optional surface to draw onto. When not given a surface
+              owned by text_layout is reused for every call with the same
+              rect size, blit the result before calling again.
 
     Returns the following values:
 
@@ -70,79 +409,685 @@ def render_textrect(string, font, rect, text_color, background_color=None, justi
 
     import pygame
     
-    final_lines = []
-
-    requested_lines = string.splitlines()
+    if justification not in (0, 1, 2):
+        raise TextRectException("Invalid justification argument: " + str(justification))
 
     # Create a series of lines that will fit on the provided
     # rectangle.
+    final_lines = text_layout.wrap(string, font, rect.width)
 
-    for requested_line in requested_lines:
-        if font.size(requested_line)[0] > rect.width:
-            words = requested_line.split(' ')
-            # if any of our words are too long to fit, return.
-            for word in words:
-                if font.size(word)[0] >= rect.width:
-                    raise TextRectException("The word " + word + " is too long to fit in the rect passed.")
-            # Start a new line
-            accumulated_line = ""
-            for word in words:
-                test_line = accumulated_line + word + " "
-                # Build the line while the words fit.    
-                if font.size(test_line)[0] < rect.width:
-                    accumulated_line = test_line 
-                else: 
-                    final_lines.append(accumulated_line) 
-                    accumulated_line = word + " " 
-            final_lines.append(accumulated_line)
-        else: 
-            final_lines.append(requested_line) 
+    line_height = font.get_height()
+    if len(final_lines) * line_height >= rect.height:
+        raise TextRectException("Once word-wrapped, the text string was too tall to fit in the rect.")
 
     # Let's try to write the text out on the surface.
 
-    surface = surface or pygame.Surface(rect.size) 
-    if background_color:
+    if surface is None:
+        key = (font, string, text_color, background_color, justification)
+        surface, up_to_date = text_layout.get_surface(rect.size, key)
+        if up_to_date:
+            return surface
+        surface.fill(background_color or BLACK)
+    elif background_color:
         surface.fill(background_color) 
 
     accumulated_height = 0 
     for line in final_lines: 
-        if accumulated_height + font.size(line)[1] >= rect.height:
-            raise TextRectException("Once word-wrapped, the text string was too tall to fit in the rect.")
         if line != "":
-            tempsurface = font.render(line, 1, text_color)
+            tempsurface = text_cache.render(font, line, text_color)
             if justification == 0:
                 surface.blit(tempsurface, (0, accumulated_height))
             elif justification == 1:
                 surface.blit(tempsurface, ((rect.width - tempsurface.get_width()) / 2, accumulated_height))
             elif justification == 2:
                 surface.blit(tempsurface, (rect.width - tempsurface.get_width(), accumulated_height))
-            else:
-                raise TextRectException("Invalid justification argument: " + str(justification))
-        accumulated_height += font.size(line)[1]
+        accumulated_height += line_height
 
     return surface
 
 
-def get_time_surface(background, font_time):
+class TextCache(object):
+    """LRU cache of rendered text surfaces keyed on font, string and colour.
+
+    Most on screen text (clock, joystick readings) only changes now and
+    then but is drawn every frame, rasterising it once is enough.
+    Returned surfaces are shared, blit them but never draw on them.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color, background=None):
+        key = (font, text, color, background)
+        try:
+            surface = self.surfaces.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            if profiler.enabled:
+                started = profiler.clock()
+            if background is None:
+                surface = font.render(text, True, color)
+            else:
+                surface = font.render(text, True, color, background)
+            if profiler.enabled:
+                profiler.nest('text', profiler.clock() - started)
+            if len(self.surfaces) >= self.maxsize:
+                self.surfaces.popitem(last=False)  # least recently used
+        self.surfaces[key] = surface
+        return surface
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def stats(self):
+        return 'text cache: %d hits, %d misses (%.1f%% hit rate), %d surfaces' % (self.hits, self.misses, self.hit_rate() * 100, len(self.surfaces))
+
+    def clear(self):
+        self.surfaces.clear()
+        self.hits = self.misses = 0
+
+text_cache = TextCache()
+
+
+def get_time_str():
     if no_secs:
-        time_str = time.strftime('%H:%M')
-    else:
-        time_str = time.strftime('%H:%M:%S')
-    time_surface = font_time.render(time_str, True, WHITE,)
+        return time.strftime('%H:%M')
+    return time.strftime('%H:%M:%S')
+
+
+_clock_gettime = None  # see real_monotonic_clock()
+_monotonic = None  # stand in while a session is installed, see InputSession
+
+def monotonic_clock():
+    """Returns a function giving monotonic seconds, the session's stand
+    in while input is recorded or replayed"""
+    return _monotonic or real_monotonic_clock()
+
+
+def real_monotonic_clock():
+    """Returns a function giving CLOCK_MONOTONIC seconds (time.monotonic()
+    is Python 3 only), time.time if clock_gettime() is not available.
+    ctypes is imported on first use, it is slow to import."""
+    global _clock_gettime
+    if _clock_gettime is None:
+        _clock_gettime = sys.modules['time'].time
+        try:
+            import ctypes
+            import ctypes.util
+
+            class timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+            librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+            clock_gettime = librt.clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            ts = timespec()
+            ts_ref = ctypes.byref(ts)
+            CLOCK_MONOTONIC = 1
+
+            def monotonic():
+                clock_gettime(CLOCK_MONOTONIC, ts_ref)
+                return ts.tv_sec + ts.tv_nsec * 1e-9
+            monotonic()
+            _clock_gettime = monotonic
+        except (ImportError, OSError, AttributeError):
+            log.warning('no_clock_gettime', fallback='time.time()')
+    return _clock_gettime
+
+def get_time_surface(background, font_time, time_str=None):
+    time_str = time_str or get_time_str()
+    time_surface = text_cache.render(font_time, time_str, WHITE)
     textRect = time_surface.get_rect()
     textRect.centerx = background.get_rect().centerx
     textRect.centery = background.get_rect().centery
     return time_surface, textRect
 
 def get_countdown_surface(background, font_time, timer_count):
-    time_str = 'Done in %d' % timer_count
-    time_surface = font_time.render(time_str, True, WHITE,)
+    """timer_count is in milliseconds, shown rounded up to whole seconds"""
+    time_str = 'Done in %d' % max(0, (timer_count + 999) // 1000)
+    time_surface = text_cache.render(font_time, time_str, WHITE)
     textRect = time_surface.get_rect()
     #textRect.left = background.get_rect().left
     #textRect.top = background.get_rect().top
     textRect.left, textRect.top = 0, 0
     return time_surface, textRect
 
+
+class DirtyRects(object):
+    """Tracks the screen regions changed since the last display update.
+
+    Overlays (clock, joystick text) are named, erased by restoring the
+    background underneath them and only redrawn when their text changes,
+    so a frame where nothing happened costs no copying at all.
+    """
+
+    def __init__(self, screen, background):
+        self.screen = screen
+        self.background = background
+        self.rects = []
+        self.overlays = {}  # name -> (key, surface, rect) currently on screen
+
+    def add(self, rect):
+        self.rects.append(pygame.Rect(rect))
+
+    def restore(self, rect):
+        """Copy rect from the background onto the screen, keeping any
+        other overlays that overlap it visible."""
+        rect = pygame.Rect(rect)
+        self.screen.blit(self.background, rect, rect)
+        self.add(rect)
+        for key, surface, overlay_rect in self.overlays.values():
+            if surface and overlay_rect.colliderect(rect):
+                self.screen.blit(surface, overlay_rect)
+                self.add(overlay_rect)
+
+    def overlay(self, name, key, surface, rect):
+        """Show surface at rect as overlay name, key identifies the content
+        (e.g. the rendered string) so unchanged overlays are skipped."""
+        old = self.overlays.get(name)
+        if old and old[0] == key and old[2] == rect:
+            return
+        if old:
+            del self.overlays[name]
+            if old[1]:
+                self.restore(old[2])
+        self.overlays[name] = (key, surface, pygame.Rect(rect))
+        if surface:
+            self.screen.blit(surface, rect)
+            self.add(rect)
+
+    def flip(self):
+        """Push all changed regions to the display"""
+        if self.rects:
+            pygame.display.update(self.rects)
+            self.rects = []
+
+
+class FrameScheduler(object):
+    """Paces a frame loop, at full frame rate only while something on
+    screen is moving.
+
+    events(active) returns the events for the next frame. While active
+    it behaves like clock.tick(fps) + pygame.event.get(), otherwise it
+    blocks in pygame.event.wait() until input arrives or timeout ms
+    pass (a TICK_EVENT timer, for the clock/countdown), so an idle
+    screen costs no CPU. An optional AnalogSampler is run for the rest
+    of each active frame instead of sleeping.
+    """
+
+    def __init__(self, clock, fps=60, sampler=None):
+        self.clock = clock
+        self.fps = fps
+        self.sampler = sampler  # AnalogSampler to run while waiting for the next frame
+        self.next_frame = 0
+        self.first = True  # never block before the first frame is drawn
+        # time the last events were fetched and the earliest they can have
+        # been queued, for input latency (see LatencyStats)
+        self.fetched = self.earliest = time.time()
+
+    def events(self, active=True, timeout=None):
+        if active or self.first or not IDLE_WAIT:
+            self.first = False
+            if self.sampler:
+                self.sampler.run_until(self.next_frame)
+            self.clock.tick(self.fps)
+            profiler.mark('tick')
+            self.next_frame = time.time() + 1.0 / self.fps
+            events = pygame.event.get()
+            self.earliest, self.fetched = self.fetched, time.time()
+            profiler.mark('events')
+            return [event for event in events if event.type != TICK_EVENT]
+        if timeout is not None:
+            pygame.time.set_timer(TICK_EVENT, max(timeout, 1))
+        events = [pygame.event.wait()]
+        self.earliest = time.time()  # woken up by the first event, up to 10 ms late
+        profiler.mark('tick')
+        events.extend(pygame.event.get())
+        self.fetched = time.time()
+        pygame.time.set_timer(TICK_EVENT, 0)
+        self.clock.tick()  # keep the clock's frame timing, no delay
+        if self.sampler:
+            self.sampler.poll()
+        profiler.mark('events')
+        return [event for event in events if event.type != TICK_EVENT]
+
+
+def clock_timeout():
+    """ms until get_time_str() changes"""
+    if no_secs:
+        period = 60 * 1000
+    else:
+        period = 1000
+    return period - int(time.time() * 1000) % period
+
+
+PROFILE_PHASES = ('tick', 'events', 'update', 'background', 'text', 'blit', 'flip')
+
+
+class FrameProfiler(object):
+    """Times each phase of every frame in the frame loops.
+
+    Loops call start(name) once, mark(phase) when a phase ends (the time
+    since the previous mark is charged to it) and end_frame() after
+    flipping, FrameScheduler marks 'tick' (sleeping/sampling until the
+    frame is due) and 'events'.  Text rendering is timed where it
+    happens, see nest(), and not charged to the phase around it.  Keeps
+    the last window frames for the overlay and writes one CSV row per
+    frame when export() was given a file.  Does nothing until enable().
+    """
+
+    def __init__(self, window=120):
+        self.enabled = False
+        self.window = window
+        self.clock = None
+        self.csv = None
+        self.loop = ''
+        self.frame = 0
+        self.current = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.totals = deque(maxlen=window)  # ms per frame
+        self.ends = deque(maxlen=window)  # frame end times, for fps
+        self.worst = 0.0
+        self.nested = 0.0
+        self.last = self.frame_start = 0.0
+        self.font = None
+        self.overlay_str = ''
+        self.overlay_at = 0.0
+
+    def enable(self):
+        # the real clock, a replayed session must not see these reads
+        self.clock = real_monotonic_clock()
+        self.enabled = True
+
+    def export(self, filename):
+        self.enable()
+        self.csv = open(filename, 'w')
+        self.csv.write('loop,frame,time,total_ms,%s\n' % ','.join(['%s_ms' % phase for phase in PROFILE_PHASES]))
+
+    def close(self):
+        if self.csv:
+            self.csv.close()
+            self.csv = None
+
+    def start(self, loop):
+        """Frame loop loop starts, statistics start over"""
+        if not self.enabled:
+            return
+        self.loop = loop
+        self.totals.clear()
+        self.ends.clear()
+        self.worst = 0.0
+        self.overlay_at = 0.0
+        self.new_frame(self.clock())
+
+    def new_frame(self, now):
+        for phase in PROFILE_PHASES:
+            self.current[phase] = 0.0
+        self.nested = 0.0
+        self.last = self.frame_start = now
+
+    def mark(self, phase):
+        """The time since the last mark was spent in phase"""
+        if not self.enabled:
+            return
+        now = self.clock()
+        self.current[phase] += now - self.last - self.nested
+        self.nested = 0.0
+        self.last = now
+
+    def nest(self, phase, secs):
+        """secs were spent in phase inside whatever phase is running"""
+        self.current[phase] += secs
+        self.nested += secs
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        now = self.clock()
+        total = (now - self.frame_start) * 1000
+        self.totals.append(total)
+        self.ends.append(now)
+        self.worst = max(self.worst, total)
+        self.frame += 1
+        if self.csv:
+            self.csv.write('%s,%d,%.6f,%.3f,%s\n' % (self.loop, self.frame, now, total, ','.join(['%.3f' % (self.current[phase] * 1000) for phase in PROFILE_PHASES])))
+        self.new_frame(now)
+
+    def fps(self):
+        if len(self.ends) < 2 or self.ends[-1] <= self.ends[0]:
+            return 0.0
+        return (len(self.ends) - 1) / (self.ends[-1] - self.ends[0])
+
+    def overlay(self, rect):
+        """(text, surface, rect) showing fps, mean and worst frame time in
+        the bottom left of rect, the text changes 4 times a second at most"""
+        self.font = layout().font(16)
+        if self.last - self.overlay_at >= 0.25 and self.totals:
+            self.overlay_str = '%.0f fps  %.1f ms  worst %.1f ms' % (self.fps(), sum(self.totals) / len(self.totals), self.worst)
+            self.overlay_at = self.last
+        surface = text_cache.render(self.font, self.overlay_str or ' ', WHITE, BLACK)
+        overlay_rect = surface.get_rect()
+        overlay_rect.bottomleft = rect.bottomleft
+        return self.overlay_str, surface, overlay_rect
+
+    def draw(self, screen):
+        """Draw the overlay onto screen, when PROFILE_OVERLAY is set"""
+        if PROFILE_OVERLAY:
+            text, surface, rect = self.overlay(screen.get_rect())
+            screen.blit(surface, rect)
+
+profiler = FrameProfiler()
+
+
+class LatencyStats(object):
+    """Per button input latency, from the input event to the display
+    flip of the frame that shows it, in milliseconds.
+
+    The input time is event.timestamp when the event source provides
+    one (time.time() based, e.g. kernel timestamps from an evdev
+    reader), otherwise the earliest time the event can have been queued
+    since the previous poll (FrameScheduler.earliest).
+    """
+
+    # histogram bucket upper edges in ms, the last bucket is open ended
+    buckets = (1, 2, 4, 8, 17, 33, 50, 67, 100, 200)
+
+    def __init__(self, keep=1000):
+        self.keep = keep  # samples kept per button for percentiles
+        self.latencies = {}  # key -> deque of latency ms
+        self.queue_delays = {}  # key -> deque of ms spent queued before pygame.event.get()
+        self.histograms = {}  # key -> list of counts per bucket
+        self.last_key = None
+
+    def add(self, key, input_time, fetched, submitted):
+        latency = (submitted - input_time) * 1000
+        if key not in self.latencies:
+            self.latencies[key] = deque(maxlen=self.keep)
+            self.queue_delays[key] = deque(maxlen=self.keep)
+            self.histograms[key] = [0] * (len(self.buckets) + 1)
+        self.latencies[key].append(latency)
+        self.queue_delays[key].append((fetched - input_time) * 1000)
+        self.histograms[key][bisect_left(self.buckets, latency)] += 1
+        self.last_key = key
+
+    def percentiles(self, key=None, queue=False):
+        """Returns (p50, p95, p99, count) for key, or all keys when None"""
+        samples = queue and self.queue_delays or self.latencies
+        if key is None:
+            values = []
+            for key_values in samples.values():
+                values.extend(key_values)
+        else:
+            values = list(samples.get(key, ()))
+        if not values:
+            return 0.0, 0.0, 0.0, 0
+        values.sort()
+        last = len(values) - 1
+        return (values[int(last * 0.50)], values[int(last * 0.95)],
+                values[int(last * 0.99)], len(values))
+
+    def summary(self, key=None):
+        if key is None:
+            name = 'all'
+        else:
+            name = key_name(key)
+        return '%s p50 %.1f p95 %.1f p99 %.1f ms (%d)' % ((name,) + self.percentiles(key))
+
+    def export(self, filename):
+        """Write per button percentiles and histograms as CSV"""
+        f = open(filename, 'w')
+        header = ['button', 'count', 'p50_ms', 'p95_ms', 'p99_ms', 'queue_p50_ms', 'queue_p99_ms']
+        header.extend(['<=%dms' % edge for edge in self.buckets])
+        header.append('>%dms' % self.buckets[-1])
+        f.write(','.join(header) + '\n')
+        for key in sorted(self.latencies):
+            p50, p95, p99, count = self.percentiles(key)
+            queue = self.percentiles(key, queue=True)
+            row = [key_name(key), count, '%.2f' % p50, '%.2f' % p95, '%.2f' % p99, '%.2f' % queue[0], '%.2f' % queue[2]]
+            row.extend(self.histograms[key])
+            f.write(','.join([str(x) for x in row]) + '\n')
+        f.close()
+
+latency_stats = LatencyStats()
+
+
+def key_name(key):
+    return pygame.key.name(key) or str(key)
+
+
+class FactoryRun(object):
+    """Pass/fail bookkeeping for an unattended run of every test.
+
+    Each test lists its criteria with require() when it starts and
+    marks them met() as they happen, it can stop as soon as passed().
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.tests = []
+        self.current = None
+
+    def begin(self, name):
+        self.current = {'name': name, 'criteria': OrderedDict(), 'notes': [], 'started': time.time()}
+        self.tests.append(self.current)
+
+    def require(self, criteria):
+        for criterion in criteria:
+            self.current['criteria'].setdefault(criterion, False)
+
+    def met(self, criterion):
+        self.current['criteria'][criterion] = True
+
+    def note(self, text):
+        """Detail for the report, e.g. why a criterion can not be met"""
+        log.info('factory_note', test=self.current['name'], note=text)
+        self.current['notes'].append(text)
+
+    def skip(self, reason):
+        """Nothing this test can check on this unit, counts as passed"""
+        self.note(reason)
+        self.current['skipped'] = True
+
+    def passed(self, test=None):
+        test = test or self.current
+        if test.get('skipped'):
+            return True
+        criteria = test['criteria']
+        return len(criteria) > 0 and all(criteria.values())
+
+    def end(self):
+        test = self.current
+        test['duration_secs'] = round(time.time() - test.pop('started'), 3)
+        test['passed'] = self.passed(test)
+        result = test.get('skipped') and 'SKIP' or test['passed'] and 'PASS' or 'FAIL'
+        log.info('factory_test', test=test['name'], result=result, secs=test['duration_secs'])
+        self.current = None
+
+    def report(self):
+        profile = system_profile()
+        return {
+            'device': {'serial': device_serial(), 'profile': profile['name']},
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'duration_secs': round(time.time() - self.started, 3),
+            'passed': all([test['passed'] for test in self.tests]),
+            'tests': self.tests,
+        }
+
+    def write(self, directory, report=None):
+        """Writes report (default report()) to a new file in directory,
+        returns its name"""
+        report = report or self.report()
+        serial = ''.join([c if c.isalnum() else '_' for c in report['device']['serial']])
+        filename = os.path.join(directory, 'factory-%s-%s.json' % (serial, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))))
+        f = open(filename + '.tmp', 'w')
+        json.dump(report, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(filename + '.tmp', filename)
+        return filename
+
+factory = None  # FactoryRun while FACTORY_MODE runs the tests
+
+
+class AssetCache(object):
+    """Images loaded once, converted to the display pixel format and
+    scaled to the requested (screen) size.
+
+    get() returns the shared cached surface (or None when the file could
+    not be loaded), copy() it before drawing on it. get(None, size)
+    returns a blank surface to use as fallback.
+    max_bytes optionally bounds the pixel memory held, least recently
+    used images are evicted first.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.surfaces = OrderedDict()  # (filename, size) -> surface or None
+        self.bytes = 0
+        self.decoded = {}  # filename -> unconverted image from preload()
+        self.lock = threading.Lock()
+        self.preloader = None
+
+    def get(self, filename, size):
+        key = (filename, tuple(size))
+        try:
+            surface = self.surfaces.pop(key)
+        except KeyError:
+            surface = self._load(filename, key[1])
+            if surface is not None:
+                self.bytes += surface.get_pitch() * surface.get_height()
+                self._evict()
+        self.surfaces[key] = surface
+        return surface
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self.bytes > self.max_bytes and len(self.surfaces) > 0:
+            key, surface = self.surfaces.popitem(last=False)
+            if surface is not None:
+                self.bytes -= surface.get_pitch() * surface.get_height()
+
+    def _load(self, filename, size):
+        if filename is None:
+            return pygame.Surface(size)
+        if self.preloader:
+            self.preloader.join()  # avoid decoding the same file twice
+            self.preloader = None
+        with self.lock:
+            image = self.decoded.pop(filename, None)
+        if image is None:
+            try:
+                image = pygame.image.load(filename)
+            except pygame.error:
+                return None
+        if image.get_size() != size:
+            try:
+                image = pygame.transform.smoothscale(image, size)
+            except ValueError:
+                # smoothscale only handles 24/32 bit images (not palettes)
+                image = pygame.transform.scale(image, size)
+        return image.convert()
+
+    def preload(self, filenames):
+        """Decode filenames on a background thread, conversion to the
+        display format happens on first get()."""
+        def decode():
+            for filename in filenames:
+                try:
+                    image = pygame.image.load(filename)
+                except pygame.error:
+                    continue
+                with self.lock:
+                    self.decoded[filename] = image
+        self.preloader = threading.Thread(target=decode)
+        self.preloader.daemon = True
+        self.preloader.start()
+
+assets = AssetCache()
+
+
+LAYOUT_BASE = (480, 272)  # resolution the pixel sizes passed to Layout were chosen for
+PROGRESS_BAR = (0.25, 0.89, 0.5, 0.037)  # normalized, see Layout.rect()
+
+
+class Layout(object):
+    """Pixel geometry for one screen size.
+
+    Screens place things with normalized rects (fractions of the
+    screen, so they stretch with it like the background images do) and
+    size fonts and fixed lengths in LAYOUT_BASE pixels (scaled by the
+    smaller of the two axis ratios, so text still fits).  Use layout()
+    to get the one Layout per resolution, everything it returns is
+    computed on first use and cached, frame loops only look things up.
+    """
+
+    def __init__(self, size):
+        self.size = tuple(size)
+        self.width, self.height = self.size
+        self.scale = min(float(self.width) / LAYOUT_BASE[0], float(self.height) / LAYOUT_BASE[1])
+        self.rects = {}  # normalized (x, y, width, height) -> Rect
+        self.fonts = {}  # pixel size -> Font
+        self.buttons = {}  # profile filename -> key -> Rect
+
+    def rect(self, x, y, width, height):
+        """Rect for normalized x, y, width, height, copy() it before
+        changing it"""
+        key = (x, y, width, height)
+        try:
+            return self.rects[key]
+        except KeyError:
+            left = int(round(x * self.width))
+            top = int(round(y * self.height))
+            rect = self.rects[key] = pygame.Rect(left, top,
+                                                 max(1, int(round((x + width) * self.width)) - left),
+                                                 max(1, int(round((y + height) * self.height)) - top))
+            return rect
+
+    def pixels(self, length):
+        """LAYOUT_BASE length in pixels at this size"""
+        return max(1, int(round(length * self.scale)))
+
+    def font(self, size):
+        """pygame's default font, size is at LAYOUT_BASE"""
+        size = self.pixels(size)
+        try:
+            return self.fonts[size]
+        except KeyError:
+            font = self.fonts[size] = pygame.font.Font(None, size)
+            return font
+
+    def button_rects(self, profile):
+        """profile['test_buttons'] as key -> Rect"""
+        try:
+            return self.buttons[profile.get('filename')]
+        except KeyError:
+            rects = self.buttons[profile.get('filename')] = dict([(key, self.rect(*box)) for key, box in profile['test_buttons'].items()])
+            return rects
+
+_layouts = {}  # size -> Layout
+
+
+def layout(size=None):
+    """Layout for size, default the display's"""
+    if size is None:
+        surface = pygame.display.get_surface()
+        size = surface and surface.get_size() or LAYOUT_BASE
+    size = tuple(size)
+    try:
+        return _layouts[size]
+    except KeyError:
+        screen_layout = _layouts[size] = Layout(size)
+        return screen_layout
+
+
 # OpenDingux SDL button mappings
 BTN_DPAD_UP = pygame.locals.K_UP
 BTN_DPAD_DOWN = pygame.locals.K_DOWN
@@ -160,105 +1105,280 @@ BTN_HOLD = pygame.locals.K_END  # NOTE OpenDingux=hold_slide
 BTN_VOL_DOWN = pygame.locals.K_1
 BTN_VOL_UP = pygame.locals.K_2
 
-papk3 = {
-                    'name': 'PAP KIII',
-                    'background': 'pap.png',
-                    'test_buttons': {
-                                        BTN_DPAD_UP: (40, 40, 20, 20),
-                                        BTN_DPAD_DOWN: (40, 100, 20, 20),
-                                        BTN_DPAD_LEFT: (10, 70, 20, 20),
-                                        BTN_DPAD_RIGHT: (70, 70, 20, 20),
-                                        BTN_A: (450, 70, 20, 20),
-                                        BTN_B: (420, 100, 20, 20),
-                                        BTN_X: (420, 40, 20, 20),
-                                        BTN_Y: (390, 70, 20, 20),
-                                        BTN_START: (435, 200, 20, 20),
-                                        BTN_SELECT: (405, 200, 20, 20),
-                                        BTN_LEFT_SHOULDER: (30, 10, 40, 20),
-                                        BTN_RIGHT_SHOULDER: (410, 10, 40, 20),
-                                        BTN_HOLD: (220, 10, 40, 20),
-                                        BTN_VOL_DOWN: (405, 170, 20, 20),
-                                        BTN_VOL_UP: (435, 170, 20, 20)
-                                    },
-                }
-
-a320 = {
-                    'name': 'Dingoo A320',
-                    'background': 'a320.png',
-                    'test_buttons': {
-                                        BTN_DPAD_UP: (40, 40, 20, 20),
-                                        BTN_DPAD_DOWN: (40, 100, 20, 20),
-                                        BTN_DPAD_LEFT: (10, 70, 20, 20),
-                                        BTN_DPAD_RIGHT: (70, 70, 20, 20),
-                                        BTN_A: (280, 70, 20, 20),
-                                        BTN_B: (250, 100, 20, 20),
-                                        BTN_X: (250, 40, 20, 20),
-                                        BTN_Y: (220, 70, 20, 20),
-                                        BTN_START: (220, 170, 20, 20),
-                                        BTN_SELECT: (70, 170, 20, 20),
-                                        BTN_LEFT_SHOULDER: (30, 10, 40, 20),
-                                        BTN_RIGHT_SHOULDER: (240, 10, 40, 20),
-                                        BTN_HOLD: (280, 130, 20, 20),
-                                        0: (280, 100, 20, 20),  # Power
-                                    },
-                }
-
 sound_buttons = {
                     BTN_START: 'audiocheck.net_c.wav',
                     BTN_LEFT_SHOULDER: 'audiocheck.net_l.wav',
                     BTN_RIGHT_SHOULDER: 'audiocheck.net_r.wav',
                 }
+sound_help = '''
+    START=both
+    Left shoulder=left
+    Right shoulder=right'''
+
+if HAVE_NUMPY:
+    # generated signals, (frequency Hz, channel, sweep end frequency Hz)
+    # channel None is all channels, 0 left, 1 right
+    sound_buttons.update({
+                    BTN_A: (440, None, None),
+                    BTN_B: (1000, None, None),
+                    BTN_Y: (10000, None, None),
+                    BTN_X: (100, None, 10000),
+                    BTN_DPAD_LEFT: (1000, 0, None),
+                    BTN_DPAD_RIGHT: (1000, 1, None),
+                })
+    sound_help += '''
+    A=440Hz B=1kHz Y=10kHz X=sweep
+    Left/Right=1kHz left/right'''
+
+
+def init_audio():
+    """Opens the mixer on first use rather than at start up"""
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(channels=system_profile()['audio_channels'])
+
+
+class ToneGenerator(object):
+    """Sine tones and sweeps built directly as sample arrays at the
+    mixer's rate/channels, cached per signal."""
+
+    def __init__(self, secs=1.0, volume=0.5, fade_secs=0.005):
+        self.secs = secs
+        self.volume = volume
+        self.fade_secs = fade_secs  # ramp in/out, avoids clicks
+        self.sounds = {}
+
+    def samples(self, freq, channel=None, freq_end=None):
+        """Returns int16 array of shape (frames, channels), or (frames,)
+        for a mono mixer (where channel is ignored)"""
+        import numpy
+        rate, size, channels = pygame.mixer.get_init()
+        frames = int(rate * self.secs)
+        t = numpy.arange(frames) / float(rate)
+        if freq_end:
+            # exponential sweep, equal time per octave
+            k = numpy.log(float(freq_end) / freq) / self.secs
+            phase = 2 * pi * freq * (numpy.exp(k * t) - 1) / k
+        else:
+            phase = 2 * pi * freq * t
+        wave = numpy.sin(phase) * (self.volume * 32767)
+        fade = min(int(rate * self.fade_secs), frames / 2)
+        if fade:
+            ramp = numpy.linspace(0.0, 1.0, fade)
+            wave[:fade] *= ramp
+            wave[-fade:] *= ramp[::-1]
+        wave = wave.astype(numpy.int16)
+        if channels == 1:
+            return wave
+        samples = numpy.zeros((frames, channels), numpy.int16)
+        if channel is None:
+            samples[:] = wave[:, numpy.newaxis]
+        else:
+            samples[:, channel] = wave
+        return samples
+
+    def sound(self, freq, channel=None, freq_end=None):
+        import pygame.sndarray
+        key = (freq, channel, freq_end, pygame.mixer.get_init())
+        try:
+            return self.sounds[key]
+        except KeyError:
+            sound = self.sounds[key] = pygame.sndarray.make_sound(self.samples(freq, channel, freq_end))
+            return sound
+
+tones = ToneGenerator()
+_sounds = {}  # key -> loaded/generated Sound
+
+
+def get_sound(key):
+    """Sound for sound_buttons[key], loaded or generated on first use.
+    Raises KeyError for keys without a sound."""
+    try:
+        return _sounds[key]
+    except KeyError:
+        source = sound_buttons[key]
+    init_audio()
+    if isinstance(source, tuple):
+        sound = tones.sound(*source)
+    else:
+        sound = pygame.mixer.Sound(source)
+    _sounds[key] = sound
+    return sound
 
 ESCAPE_IS_QUIT = True
 ESCAPE_IS_QUIT = False
 TEST_TIMEOUT = 10 * 1000  # 10 seconds
+DIRTY_RECTS = True  # only push changed regions to the display, see DirtyRects
+IDLE_WAIT = True  # sleep until input when nothing moves, see FrameScheduler
+TICK_EVENT = pygame.locals.USEREVENT + 1
+LATENCY_MODE = False  # measure button to display latency in test_buttons
+EVDEV_INPUT = False  # read /dev/input directly, see EvdevReader
+LATENCY_FILE = 'latency.csv'
+ANALOG_SAMPLE_RATE = 1000  # Hz, joystick sampling between frames, 0 = once per frame
+RECORD_DIR = None  # directory to record analog test captures into, see SampleRecorder
+FACTORY_MODE = False  # run every test unattended and write a report, see run_factory()
+FACTORY_REPORT_DIR = '.'
+FACTORY_EDGE = 0.95  # stick reading counted as reaching the edge of the box
+FACTORY_RESULT_TIMEOUT = 3 * 1000  # PASS/FAIL screen, the report is already written
+FACTORY_BENCH_SECS = 0.2  # per display benchmark operation in factory runs
+FACTORY_DISPLAY_FPS = 50  # whole frames per second the display must reach, under 60 Hz vsync
+DISPLAY_DEPTH = 0  # bits per pixel, 0 lets SDL pick (the dummy driver picks 8, too few)
+PROFILE_OVERLAY = False  # show fps and frame times, see FrameProfiler
+PROFILE_FILE = 'profile.csv'
+DISPLAY_BENCH_SECS = 0.5  # per operation, see display_benchmark()
+DISPLAY_RES = None  # (width, height) to open, None picks, see display_resolution()
+WINDOWED_DRIVERS = ('x11', 'wayland', 'windib', 'directx', 'Quartz', 'cocoa', 'dummy')  # SDL video drivers that open a window
+CALIBRATION_FILE = 'calibration.json'  # per device deadzone/centre, see calibrate()
+CALIBRATE_SECS = 3  # resting stick sampled for this long
+CALIBRATE_MARGIN = 1.5  # proposed deadzone = worst excursion from centre * margin
+MIC_WAV = None  # WAV file test_mic uses instead of the microphone, see open_mic()
+MIC_FFT_SIZE = 1024  # samples per spectrum
+MIC_BANDS = 24  # spectrum bars
+MIC_FLOOR_DB = -72.0  # bottom of the level and spectrum bars, dBFS
+MIC_FACTORY_DB = -60.0  # level that passes the factory 'mic level' check, dBFS
+MIC_FACTORY_SECS = 1.0  # of captured audio at that level, not just a click
+LOOPBACK_FREQS = (200, 315, 500, 800, 1250, 2000, 3150, 5000)  # Hz, stepped through per channel
+LOOPBACK_STEP_SECS = 0.1  # per frequency
+LOOPBACK_GAP_SECS = 0.2  # silence before, between and after the channels
+LOOPBACK_VOLUME = 0.5
+LOOPBACK_LATENCY_SECS = 0.3  # recording goes on this long after playback
+LOOPBACK_DEAD_DB = -50.0  # channel quieter than this (median, dBFS) is dead
+LOOPBACK_MAX_THD = 10.0  # percent, worse than this is distorted
+LOOPBACK_RANGE_DB = 20.0  # THD only counts for steps this close to the loudest
 
 
 def test_sound(clock, screen, font_time, font_text, j):
     image_filename = 'wallpaper.png'
     my_rect = screen.get_rect()
     
-    try:
-        # NOTE image needs to match screen res
-        # TODO handle images too small/large
-        background = pygame.image.load(image_filename)
-        background = background.convert()
-    except pygame.error:
-        background = pygame.Surface(my_rect.size)
+    background = assets.get(image_filename, my_rect.size)
+    if background is None:
+        background = assets.get(None, my_rect.size)
+    background = background.copy()  # cached surface is shared
     
-    text_str = '''
-    START=both
-    Left shoulder=left
-    Right shoulder=right
+    loopback = have_loopback()
+    text_str = sound_help
+    if loopback:
+        text_str += '''
+    Up=check speakers through the mic'''
+    text_str += '''
     SELECT=quit'''
     rendered_text = render_textrect(text_str, font_text, my_rect, WHITE, surface=background)
     if rendered_text:
         background.blit(rendered_text, my_rect.topleft)
 
+    progress_rect = layout(my_rect.size).rect(*PROGRESS_BAR)
+    check_margin = layout(my_rect.size).pixels(10)  # under the check result lines
+    check = None  # LoopbackCheck running
+    check_lines = []  # its results
+
+    to_play = []  # (criterion, key) still to play unattended
+    playing = None  # (criterion, channel)
+    if factory and loopback:
+        init_audio()
+        rate, size, channels = pygame.mixer.get_init()
+        factory.require(['%s speaker' % name for name, channel, start in loopback_layout(rate, channels)])
+        try:
+            check = LoopbackCheck()
+        except (OSError, IOError, EOFError, wave.Error, pygame.error), info:
+            factory.note('microphone failed: %s' % info)
+    elif factory:
+        if HAVE_NUMPY:
+            to_play = [('left channel', BTN_DPAD_LEFT), ('right channel', BTN_DPAD_RIGHT)]
+        else:
+            to_play = [('left channel', BTN_LEFT_SHOULDER), ('right channel', BTN_RIGHT_SHOULDER)]
+        factory.require([criterion for criterion, key in to_play])
+
+    scheduler = FrameScheduler(clock, 60)  # 60 times a second at most
+    profiler.start('test_sound')
     keepGoing = True
     while keepGoing:
-        #clock.tick(4)  # 4 times a second
-        clock.tick(60)  # 60 times a second
+        # while playing, look at the channel 10 times a second
+        events = scheduler.events(active=check is not None, timeout=playing and 100 or clock_timeout())
+        if check is not None:
+            try:
+                results = check.poll()
+            except SpawnError, info:
+                log.error('mic_capture_failed', error=str(info))
+                check.cancel()
+                results = []
+                if factory:
+                    factory.note('microphone failed: %s' % info)
+            if results is not None:
+                check = None
+                check_lines = [loopback_summary(result) for result in results]
+                if factory:
+                    for result in results:
+                        if loopback_verdict(result) == 'OK':
+                            factory.met('%s speaker' % result['name'])
+                        else:
+                            factory.note(loopback_summary(result))
+                    keepGoing = False
+        elif factory:
+            if playing and not playing[1].get_busy():
+                factory.met(playing[0])
+                playing = None
+            if playing is None:
+                if to_play:
+                    criterion, key = to_play.pop(0)
+                    try:
+                        channel = get_sound(key).play()
+                    except pygame.error, info:
+                        factory.note('%s: %s' % (criterion, info))
+                        channel = None
+                    if channel:
+                        playing = (criterion, channel)
+                    else:
+                        to_play = []
+                else:
+                    keepGoing = False  # all played (or failed)
         bg = background.copy()
+        profiler.mark('background')
         # update an on screen clock to show activity (and not hung)
         # TODO replace with a count down timer and have button test auto quit?
         time_surface, textRect = get_time_surface(bg, font_time)
         bg.blit(time_surface, textRect)
-        for event in pygame.event.get(): 
+        for event in events: 
             if event.type == pygame.QUIT:
                 keepGoing = False  # Quit
             elif event.type == pygame.KEYDOWN:
+                if event.key == BTN_DPAD_UP and loopback:
+                    if check is None:
+                        try:
+                            check = LoopbackCheck()
+                        except (OSError, IOError, EOFError, wave.Error, pygame.error), info:
+                            log.error('mic_open_failed', error=str(info))
+                        check_lines = []
+                    continue
                 try:
-                    sound = sound_buttons[event.key]
+                    sound = get_sound(event.key)
                     sound.play()
                 except KeyError:
                     # TODO display to screen too?
-                    print 'Unsupported button/key pressed', event.key
+                    log.warning('unsupported_key', key=event.key, state='pressed')
                 if event.key == BTN_SELECT:
                     keepGoing = False  # Quit
+        if check is not None:
+            pygame.draw.rect(bg, BOX_OUTLINE, progress_rect, 1)
+            done_rect = progress_rect.inflate(-4, -4)
+            done_rect.width = int(done_rect.width * check.progress())
+            bg.fill(PRESSED_ACTIVE, done_rect)
+        for n, line in enumerate(check_lines):
+            text = text_cache.render(font_text, line, 'OK' in line.split() and WHITE or RED)
+            text_rect = text.get_rect()
+            text_rect.centerx = my_rect.centerx
+            text_rect.bottom = my_rect.bottom - check_margin - (len(check_lines) - n - 1) * text_rect.height
+            bg.blit(text, text_rect)
+        profiler.mark('update')
             
         screen.blit(bg, (0, 0))
+        profiler.draw(screen)
+        profiler.mark('blit')
         pygame.display.flip()
+        profiler.mark('flip')
+        profiler.end_frame()
+
+    if check is not None:
+        check.cancel()
 
 
 class BaseException(Exception):
@@ -269,43 +1389,520 @@ class SpawnError(BaseException):
     '''Spawned process exception'''
 
 
-def execute(command):
-    errors_output = subprocess.PIPE
-    
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    data = p.stdout.read()
-    data_err = p.stderr.read()
-    
-    rc = p.wait()
-    
-    if rc:
-        raise SpawnError('error spawning rc=%r %r stderr=%r stdout=%r' % (rc, command, data_err, data))
-    
-    return data, data_err
+class Spawn(object):
+    """Runs command with its stdout and stderr drained by threads, so
+    neither pipe can fill up and block the child.
+
+    on_stdout(data) is called (on the reader thread) with each chunk as
+    it arrives, otherwise stdout is collected in memory.
+    """
+
+    chunk_size = 4096
+
+    def __init__(self, command, on_stdout=None):
+        self.command = command
+        self.p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.stdout_chunks = []
+        self.stderr_chunks = []
+        self.readers = [
+            threading.Thread(target=self._drain, args=(self.p.stdout, on_stdout or self.stdout_chunks.append)),
+            threading.Thread(target=self._drain, args=(self.p.stderr, self.stderr_chunks.append)),
+        ]
+        for reader in self.readers:
+            reader.daemon = True
+            reader.start()
+
+    def _drain(self, pipe, callback):
+        fd = pipe.fileno()
+        while True:
+            data = os.read(fd, self.chunk_size)  # returns what is there, unlike pipe.read()
+            if not data:
+                break
+            callback(data)
+        pipe.close()
+
+    def done(self):
+        """True once the child exited and all its output was read"""
+        return self.p.poll() is not None and not [reader for reader in self.readers if reader.is_alive()]
+
+    def wait(self):
+        """Returns the exit code, once all output was read"""
+        for reader in self.readers:
+            reader.join()
+        return self.p.wait()
+
+    def cancel(self, grace=0.5):
+        """Stop the child, SIGTERM then SIGKILL after grace seconds"""
+        if self.p.poll() is not None:
+            return
+        self.p.terminate()
+        deadline = time.time() + grace
+        while self.p.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if self.p.poll() is None:
+            self.p.kill()
+        self.p.wait()
+
+    @property
+    def stdout(self):
+        return ''.join(self.stdout_chunks)
+
+    @property
+    def stderr(self):
+        return ''.join(self.stderr_chunks)
+
+
+class MicStream(object):
+    """Live mono S16_LE microphone PCM, read() returns whatever arrived
+    since the last call (possibly nothing), never blocks.
+
+    ArecordStream is the real microphone, WavStream a stand in."""
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ArecordStream(MicStream):
+    """arecord run until closed, its stdout drained by Spawn threads"""
+
+    def __init__(self, rate):
+        MicStream.__init__(self, rate)
+        self.chunks = deque()
+        command = ['arecord', '--nonblock', '--file-type=raw', '--format=S16_LE', '--rate=%d' % rate, '--channels=1']
+        self.spawn = Spawn(command, on_stdout=self.chunks.append)
+
+    def read(self):
+        """Raises SpawnError once arecord failed and nothing is left"""
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.chunks.popleft())
+            except IndexError:
+                break
+        if not chunks and self.spawn.done():
+            raise SpawnError('error spawning rc=%r %r stderr=%r' % (self.spawn.wait(), self.spawn.command, self.spawn.stderr))
+        return ''.join(chunks)
+
+    def close(self):
+        self.spawn.cancel()
+
+
+class WavStream(MicStream):
+    """WAV file played as if it was the microphone, in real time and
+    looped, converted to mono S16 at rate"""
+
+    def __init__(self, filename, rate):
+        MicStream.__init__(self, rate)
+        self.wav = wave.open(filename, 'rb')
+        if self.wav.getnframes() <= 0:
+            self.wav.close()
+            raise wave.Error('%s has no frames' % filename)
+        self.state = None  # audioop.ratecv() state
+        self.started = time.time()
+        self.sent = 0  # frames returned so far
+
+    def read(self):
+        due = int((time.time() - self.started) * self.rate) - self.sent
+        if due <= 0:
+            return ''
+        wav_rate = self.wav.getframerate()
+        width = self.wav.getsampwidth()
+        chunks = []
+        frames = 0
+        while frames < due:
+            data = self.wav.readframes(int(ceil((due - frames) * float(wav_rate) / self.rate)))
+            if not data:
+                self.wav.rewind()
+                continue
+            data = pcm_to_s16(data, width)
+            if self.wav.getnchannels() == 2:
+                data = audioop.tomono(data, 2, 0.5, 0.5)
+            if wav_rate != self.rate:
+                data, self.state = audioop.ratecv(data, 2, 1, wav_rate, self.rate, self.state)
+            chunks.append(data)
+            frames += len(data) / 2
+        self.sent += due
+        return ''.join(chunks)[:due * 2]
+
+    def close(self):
+        self.wav.close()
+
+
+def pcm_to_s16(data, width):
+    """WAV PCM of any sample width to S16"""
+    if width == 1:
+        data = audioop.bias(data, 1, -128)  # 8 bit WAV is unsigned
+    if width != 2:
+        data = audioop.lin2lin(data, width, 2)
+    return data
+
+
+def read_wav(filename, rate):
+    """Whole WAV file as mono S16 PCM at rate"""
+    f = wave.open(filename, 'rb')
+    try:
+        data = pcm_to_s16(f.readframes(f.getnframes()), f.getsampwidth())
+        if f.getnchannels() == 2:
+            data = audioop.tomono(data, 2, 0.5, 0.5)
+        if f.getframerate() != rate:
+            data = audioop.ratecv(data, 2, 1, f.getframerate(), rate, None)[0]
+    finally:
+        f.close()
+    return data
+
+
+def open_mic(rate):
+    """MicStream for test_mic, MIC_WAV instead of the microphone when set"""
+    if MIC_WAV:
+        return WavStream(MIC_WAV, rate)
+    return ArecordStream(rate)
+
+
+class MicMeter(object):
+    """RMS level, peak and spectrum of a MicStream, drawn as bars.
+
+    feed() takes the PCM that arrived since the previous frame, the
+    level covers all of it, the spectrum only the last fft_size samples,
+    so the work per frame stays the same however late a frame is.
+    Without NumPy there is no spectrum.  Levels are dBFS, clipped to
+    MIC_FLOOR_DB.
+    """
+
+    peak_fall = 20.0  # dB per second the held peak falls back
+
+    def __init__(self, rate, fft_size=None, bands=None):
+        self.rate = rate
+        self.fft_size = fft_size or MIC_FFT_SIZE
+        self.bands = bands or MIC_BANDS
+        self.rms_db = self.peak_db = self.held_db = MIC_FLOOR_DB
+        self.held_at = None
+        self.tail = ''  # last fft_size samples
+        self.spectrum = None  # dBFS per band
+        if HAVE_NUMPY:
+            import numpy
+            self.window = numpy.hanning(self.fft_size).astype(numpy.float32)
+            # the window halves the amplitude, so a full scale sine is 0 dB
+            self.window_gain = self.window.sum() / 2
+            # log spaced bands from 50 Hz up, empty ones merged
+            bins = self.fft_size / 2 + 1
+            low = max(1, int(50.0 * self.fft_size / rate))
+            edges = numpy.logspace(numpy.log10(low), numpy.log10(bins), self.bands + 1).astype(int)
+            self.band_edges = numpy.unique(numpy.clip(edges, low, bins - 1))[:-1]
+
+    def db(self, level):
+        if level <= 0:
+            return MIC_FLOOR_DB
+        return max(MIC_FLOOR_DB, 20 * log10(level))
+
+    def feed(self, data, now=None):
+        data = data[:len(data) - len(data) % 2]
+        if not data:
+            return
+        self.tail = (self.tail + data)[-self.fft_size * 2:]
+        if HAVE_NUMPY:
+            import numpy
+            samples = numpy.frombuffer(data, dtype='<i2').astype(numpy.float32) / 32768
+            ac = samples - samples.mean()  # codec DC bias is not sound
+            self.rms_db = self.db(float(numpy.sqrt(numpy.mean(ac * ac))))
+            self.peak_db = self.db(float(numpy.abs(samples).max()))
+            if len(self.tail) == self.fft_size * 2:
+                tail = numpy.frombuffer(self.tail, dtype='<i2').astype(numpy.float32) / 32768
+                magnitude = numpy.abs(numpy.fft.rfft(tail * self.window)) / self.window_gain
+                bands = numpy.maximum.reduceat(magnitude, self.band_edges)
+                self.spectrum = numpy.maximum(MIC_FLOOR_DB, 20 * numpy.log10(numpy.maximum(bands, 1e-9))).tolist()
+        else:
+            rms, dc = audioop.rms(data, 2), audioop.avg(data, 2)
+            self.rms_db = self.db(sqrt(max(0, rms * rms - dc * dc)) / 32768.0)  # without the DC bias
+            self.peak_db = self.db(audioop.max(data, 2) / 32768.0)
+        if now is None:
+            now = time.time()
+        if self.held_at is not None:
+            self.held_db = max(MIC_FLOOR_DB, self.held_db - (now - self.held_at) * self.peak_fall)
+        self.held_at = now
+        self.held_db = max(self.held_db, self.peak_db)
+
+    def fraction(self, db):
+        return 1.0 - float(db) / MIC_FLOOR_DB
+
+    def draw(self, surface, level_rect, spectrum_rect):
+        """Level bar (RMS filled, held peak as a line, red when clipping)
+        in level_rect, one bar per band in spectrum_rect"""
+        pygame.draw.rect(surface, BOX_OUTLINE, level_rect, 1)
+        inner = level_rect.inflate(-4, -4)
+        filled = inner.copy()
+        filled.width = int(inner.width * self.fraction(self.rms_db))
+        surface.fill(PRESSED_ACTIVE, filled)
+        x = inner.left + int((inner.width - 2) * self.fraction(self.held_db))
+        surface.fill(self.held_db > -1 and RED or WHITE, (x, inner.top, 2, inner.height))
+        if self.spectrum is None:
+            return
+        pygame.draw.rect(surface, BOX_OUTLINE, spectrum_rect, 1)
+        inner = spectrum_rect.inflate(-4, -4)
+        width = inner.width / len(self.spectrum)
+        for n, db in enumerate(self.spectrum):
+            height = int(inner.height * self.fraction(db))
+            if height > 0:
+                surface.fill(PRESSED_DONE, (inner.left + n * width, inner.bottom - height, max(1, width - 1), height))
+
+
+def loopback_layout(rate, channels):
+    """Where loopback_stimulus() plays what, list of (channel name,
+    channel index, first frame of the first step), one entry per
+    channel, a gap between them so echoes die down"""
+    names = channels == 1 and ['mono'] or ['left', 'right'] + ['channel %d' % n for n in range(2, channels)]
+    step = int(rate * LOOPBACK_STEP_SECS)
+    gap = int(rate * LOOPBACK_GAP_SECS)
+    return [(names[n], n, gap + n * (len(LOOPBACK_FREQS) * step + gap)) for n in range(channels)]
+
+
+def loopback_stimulus(rate, channels):
+    """int16 array (frames, channels), or (frames,) for mono, stepping
+    through LOOPBACK_FREQS on one channel after the other, laid out as
+    loopback_layout() says"""
+    import numpy
+    step = int(rate * LOOPBACK_STEP_SECS)
+    fade = int(rate * 0.005)
+    layout = loopback_layout(rate, channels)
+    frames = layout[-1][2] + len(LOOPBACK_FREQS) * step + int(rate * LOOPBACK_GAP_SECS)
+    t = numpy.arange(step) / float(rate)
+    ramp = numpy.ones(step)
+    ramp[:fade] = ramp[-fade:][::-1] = numpy.linspace(0.0, 1.0, fade)
+    steps = numpy.sin(2 * pi * numpy.outer(LOOPBACK_FREQS, t)) * ramp * (LOOPBACK_VOLUME * 32767)
+    steps = steps.astype(numpy.int16).ravel()
+    samples = numpy.zeros((frames, channels), numpy.int16)
+    for name, channel, start in layout:
+        samples[start:start + len(steps), channel] = steps
+    if channels == 1:
+        return samples[:, 0]
+    return samples
+
+
+def analyse_loopback(played, captured, rate):
+    """Frequency response and THD of every channel of the played
+    loopback_stimulus() array in captured (mono S16 PCM string at the
+    same rate, recorded from before playback started).
+
+    The capture is aligned to the stimulus by cross correlation, then
+    the middle of every step of every channel is windowed and all of
+    them go through one batched FFT.  Returns a list of dicts, one per
+    channel: name, level_db (median fundamental, dBFS), response_db
+    (per LOOPBACK_FREQS, relative to level_db), thd_pct (per step),
+    dead and distorted.
+    """
+    import numpy
+    channels = played.ndim == 1 and 1 or played.shape[1]
+    layout = loopback_layout(rate, channels)
+    reference = played.reshape(len(played), -1).sum(axis=1).astype(numpy.float32) / 32768
+    capture = numpy.frombuffer(captured[:len(captured) - len(captured) % 2], dtype='<i2').astype(numpy.float32) / 32768
+
+    # latency: lag with the best cross correlation, capture lags playback
+    size = 1 << int(ceil(numpy.log2(max(1, len(capture) + len(reference)))))
+    correlation = numpy.fft.irfft(numpy.fft.rfft(capture, size) * numpy.conj(numpy.fft.rfft(reference, size)), size)
+    lag = int(numpy.argmax(correlation[:max(1, len(capture) - len(reference) / 2)]))
+
+    # analyse the middle of each step, power of two frames
+    step = int(rate * LOOPBACK_STEP_SECS)
+    size = 1 << int(numpy.log2(step * 0.75))
+    guard = (step - size) / 2
+    starts = numpy.array([lag + start + n * step + guard for name, channel, start in layout for n in range(len(LOOPBACK_FREQS))])
+    capture = numpy.concatenate([capture, numpy.zeros(max(0, starts.max() + size - len(capture)), numpy.float32)])
+    window = numpy.hanning(size).astype(numpy.float32)
+    segments = capture[starts[:, numpy.newaxis] + numpy.arange(size)] * window
+    magnitude = numpy.abs(numpy.fft.rfft(segments, axis=1)) / (window.sum() / 2)
+
+    # amplitude of the fundamental and harmonics 2-5, max within +-2 bins
+    freqs = numpy.tile(LOOPBACK_FREQS, len(layout))
+    harmonics = numpy.outer(freqs, numpy.arange(1, 6)) * size / float(rate)
+    bins = numpy.rint(harmonics)[:, :, numpy.newaxis].astype(int) + numpy.arange(-2, 3)
+    audible = harmonics < size / 2 - 2
+    bins = numpy.clip(bins, 0, size / 2)
+    rows = numpy.arange(len(freqs))[:, numpy.newaxis, numpy.newaxis]
+    amplitude = magnitude[rows, bins].max(axis=2) * audible
+    fundamental = numpy.maximum(amplitude[:, 0], 1e-9)
+    thd = numpy.sqrt((amplitude[:, 1:] ** 2).sum(axis=1)) / fundamental * 100
+    level = 20 * numpy.log10(fundamental)
+
+    results = []
+    for n, (name, channel, start) in enumerate(layout):
+        steps = slice(n * len(LOOPBACK_FREQS), (n + 1) * len(LOOPBACK_FREQS))
+        channel_level = float(numpy.median(level[steps]))
+        dead = channel_level < LOOPBACK_DEAD_DB
+        # only steps the speaker plays loud enough, below that THD is noise
+        loud = level[steps] > level[steps].max() - LOOPBACK_RANGE_DB
+        worst_thd = float(thd[steps][loud].max())
+        results.append({
+            'name': name,
+            'level_db': round(channel_level, 1),
+            'response_db': [round(value, 1) for value in (level[steps] - channel_level).tolist()],
+            'thd_pct': [round(value, 2) for value in thd[steps].tolist()],
+            'worst_thd_pct': round(worst_thd, 2),
+            'latency_ms': round(lag * 1000.0 / rate, 1),
+            'dead': dead,
+            'distorted': not dead and worst_thd > LOOPBACK_MAX_THD,
+        })
+    return results
+
+
+def loopback_verdict(result):
+    if result['dead']:
+        return 'DEAD'
+    if result['distorted']:
+        return 'DISTORTED'
+    return 'OK'
+
+
+def loopback_summary(result):
+    """One line for the screen"""
+    if result['dead']:
+        return '%s DEAD  %.0f dBFS' % (result['name'], result['level_db'])
+    return '%s %s  %.0f dBFS  THD %.1f%%' % (result['name'], loopback_verdict(result), result['level_db'], result['worst_thd_pct'])
+
+
+def log_loopback(results):
+    for result in results:
+        log.info('loopback', channel=result['name'], verdict=loopback_verdict(result),
+                 level_db=result['level_db'], worst_thd_pct=result['worst_thd_pct'], latency_ms=result['latency_ms'],
+                 response_db=','.join(['%+.1f' % value for value in result['response_db']]),
+                 thd_pct=','.join(['%.1f' % value for value in result['thd_pct']]))
+
+
+def have_loopback():
+    """LoopbackCheck needs NumPy and a microphone (or MIC_WAV)"""
+    return HAVE_NUMPY and ('mic' in system_profile()['sensors'] or bool(MIC_WAV))
+
+
+def write_wav(filename, samples, rate, channels):
+    """S16 PCM string or int16 array to a WAV file"""
+    if not isinstance(samples, str):
+        samples = samples.tostring()
+    f = wave.open(filename, 'wb')
+    try:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(samples)
+    finally:
+        f.close()
+
+
+def check_loopback_files(played_filename, recorded_filename):
+    """analyse_loopback() of a stimulus and recording saved by
+    LoopbackCheck (or any WAV pair recorded with the same LOOPBACK_*
+    settings), the recording is converted to the played rate"""
+    import numpy
+    f = wave.open(played_filename, 'rb')
+    try:
+        rate, channels = f.getframerate(), f.getnchannels()
+        played = numpy.frombuffer(pcm_to_s16(f.readframes(f.getnframes()), f.getsampwidth()), dtype='<i2')
+    finally:
+        f.close()
+    if channels > 1:
+        played = played.reshape(-1, channels)
+    return analyse_loopback(played, read_wav(recorded_filename, rate), rate)
+
+
+class LoopbackCheck(object):
+    """Plays loopback_stimulus() while recording it with open_mic(), one
+    frame at a time, poll() every frame until it returns the results of
+    analyse_loopback().  The stimulus and the recording are saved as a
+    WAV pair in RECORD_DIR when set, for check_loopback_files()."""
+
+    def __init__(self):
+        import pygame.sndarray
+        init_audio()
+        self.rate, size, self.channels = pygame.mixer.get_init()
+        self.stimulus = loopback_stimulus(self.rate, self.channels)
+        self.stream = open_mic(self.rate)  # before playing, it must not miss the start
+        self.chunks = []
+        self.sound = pygame.sndarray.make_sound(self.stimulus)
+        self.sound.play()
+        self.started = time.time()
+        self.secs = len(self.stimulus) / float(self.rate) + LOOPBACK_LATENCY_SECS
+        self.results = None
+
+    def progress(self):
+        """0.0 - 1.0, by time"""
+        return min(1.0, (time.time() - self.started) / self.secs)
+
+    def poll(self):
+        """Results once done, otherwise None.  Raises SpawnError if
+        the microphone failed."""
+        if self.results is None:
+            self.chunks.append(self.stream.read())
+            if time.time() - self.started >= self.secs:
+                self.stream.close()
+                captured = ''.join(self.chunks)
+                if RECORD_DIR:
+                    name = os.path.join(RECORD_DIR, 'loopback-%s' % time.strftime('%Y%m%d-%H%M%S'))
+                    write_wav(name + '-played.wav', self.stimulus, self.rate, self.channels)
+                    write_wav(name + '-recorded.wav', captured, self.rate, 1)
+                self.results = analyse_loopback(self.stimulus, captured, self.rate)
+                log_loopback(self.results)
+        return self.results
+
+    def cancel(self):
+        self.sound.stop()
+        self.stream.close()
+
+
+def pcm_to_sound(data):
+    """Mono S16 PCM (at the mixer rate) to a pygame Sound"""
+    mono = array('h')
+    mono.fromstring(data[:len(data) - len(data) % 2])
+    channels = pygame.mixer.get_init()[2]
+    if channels == 1:
+        return pygame.mixer.Sound(buffer=mono.tostring())
+    samples = array('h', [0]) * (len(mono) * channels)
+    for channel in range(channels):
+        samples[channel::channels] = mono
+    return pygame.mixer.Sound(buffer=samples.tostring())
 
 
 def test_mic(clock, screen, font_time, font_text, j):
-    temp_filename = '/tmp/delme.wav'
     num_secs = 3
-    command = ['arecord', '--nonblock', '--format=S16_LE', '-d %d' % num_secs, '--rate=11025', '--channels=1', temp_filename]
+    if factory and have_loopback():
+        # the Sound test heard every speaker through it, a better check
+        # than any level, which DC bias or hum on a dead mic can reach
+        factory.skip('checked by the Sound test speaker loopback')
+        return
+    init_audio()
     
     class FakeSound(object):
         def play(self):
             pass
     
     sound = FakeSound()
+    rate = pygame.mixer.get_init()[0]
+    clip = None  # chunks of the clip being recorded
+    clip_bytes = 0
+    meter = MicMeter(rate)
+    try:
+        stream = open_mic(rate)
+    except (OSError, IOError, EOFError, wave.Error), info:
+        log.error('mic_open_failed', error=str(info))
+        stream = None
+        if factory:
+            factory.note('microphone failed: %s' % info)
+    if factory:
+        factory.require(['mic level'])
+        if stream is None:
+            return
+        started = pygame.time.get_ticks()
+        heard = 0.0  # secs of audio at MIC_FACTORY_DB or above
 
     image_filename = 'wallpaper.png'
     my_rect = screen.get_rect()
     
-    try:
-        # NOTE image needs to match screen res
-        # TODO handle images too small/large
-        background = pygame.image.load(image_filename)
-        background = background.convert()
-    except pygame.error:
-        background = pygame.Surface(my_rect.size)
+    background = assets.get(image_filename, my_rect.size)
+    if background is None:
+        background = assets.get(None, my_rect.size)
+    background = background.copy()  # cached surface is shared
     
     text_str = '''Microphone Test
     Left shoulder=record %d secs
@@ -315,77 +1912,290 @@ def test_mic(clock, screen, font_time, font_text, j):
     if rendered_text:
         background.blit(rendered_text, my_rect.topleft)
 
+    screen_layout = layout(my_rect.size)
+    progress_rect = screen_layout.rect(*PROGRESS_BAR)
+    level_rect = screen_layout.rect(0.042, 0.8, 0.917, 0.051)
+    spectrum_rect = screen_layout.rect(0.042, 0.25, 0.917, 0.515)
+
+    scheduler = FrameScheduler(clock, 60)  # 60 times a second at most
+    profiler.start('test_mic')
     keepGoing = True
     while keepGoing:
-        #clock.tick(4)  # 4 times a second
-        clock.tick(60)  # 60 times a second
+        # full frame rate while the meter runs
+        events = scheduler.events(active=stream is not None, timeout=clock_timeout())
         bg = background.copy()
+        profiler.mark('background')
         # update an on screen clock to show activity (and not hung)
         # TODO replace with a count down timer and have button test auto quit?
         time_surface, textRect = get_time_surface(bg, font_time)
+        textRect.topright = my_rect.topright  # out of the spectrum's way
         bg.blit(time_surface, textRect)
-        for event in pygame.event.get(): 
+        for event in events: 
             if event.type == pygame.QUIT:
                 keepGoing = False  # Quit
             elif event.type == pygame.KEYDOWN:
                 if event.key == BTN_SELECT:
                     keepGoing = False  # Quit
                 elif event.key == BTN_LEFT_SHOULDER:
-                    d = execute(command)
-                    # TODO sound a ping noise to show recording completed
-                    print 'DEBUG', d
-                    sound = pygame.mixer.Sound(temp_filename)
-                    #sound = pygame.mixer.Sound('audiocheck.net_c.wav')  # DEBUG
+                    if clip is None and stream is not None:
+                        clip = []
+                        clip_bytes = 0
                 elif event.key == BTN_RIGHT_SHOULDER:
                     sound.play()
                 else:
                     # TODO display to screen too?
-                    print 'Unsupported button/key pressed', event.key
+                    log.warning('unsupported_key', key=event.key, state='pressed')
+
+        if stream is not None:
+            try:
+                data = stream.read()
+            except SpawnError, info:
+                log.error('mic_capture_failed', error=str(info))
+                stream = None
+                clip = None
+                data = ''
+                if factory:
+                    factory.note('microphone failed: %s' % info)
+                    keepGoing = False
+            meter.feed(data)
+            meter.draw(bg, level_rect, spectrum_rect)
+            if factory and data and meter.rms_db >= MIC_FACTORY_DB:
+                heard += len(data) / 2.0 / rate
+                if heard >= MIC_FACTORY_SECS:
+                    factory.met('mic level')
+        if clip is not None:
+            clip.append(data)
+            clip_bytes += len(data)
+            if clip_bytes >= num_secs * rate * 2:
+                # TODO sound a ping noise to show recording completed
+                sound = pcm_to_sound(''.join(clip)[:num_secs * rate * 2])
+                clip = None
+            else:
+                pygame.draw.rect(bg, BOX_OUTLINE, progress_rect, 1)
+                done_rect = progress_rect.inflate(-4, -4)
+                done_rect.width = int(done_rect.width * clip_bytes / (num_secs * rate * 2.0))
+                bg.fill(PRESSED_ACTIVE, done_rect)
+        profiler.mark('update')
             
         screen.blit(bg, (0, 0))
+        profiler.draw(screen)
+        profiler.mark('blit')
         pygame.display.flip()
+        profiler.mark('flip')
+        profiler.end_frame()
+        if factory and (factory.passed() or pygame.time.get_ticks() - started >= TEST_TIMEOUT):
+            keepGoing = False  # heard something, or never will
+
+    if stream is not None:
+        stream.close()
+
+
+def gradient_surface(size, screen):
+    """Grey, red, green and blue bands, each dark to bright left to right"""
+    width, height = size
+    surface = pygame.Surface(size, 0, screen)
+    band = height / 4
+    for x in range(width):
+        level = x * 255 / max(1, width - 1)
+        for n, color in enumerate([(level, level, level), (level, 0, 0), (0, level, 0), (0, 0, level)]):
+            pygame.draw.line(surface, color, (x, n * band), (x, (n + 1) * band - 1))
+    return surface
+
+
+def display_benchmark(screen, secs=None):
+    """Times fill, Surface.copy(), blit, flip and a whole frame the way
+    the test screens draw one (copy, blit, flip) on screen, secs each.
+    Returns list of (name, per second, MB/s), MB/s counts a full screen
+    of pixels per operation."""
+    secs = secs or DISPLAY_BENCH_SECS
+    clock = real_monotonic_clock()
+    background = screen.copy()
+    frame_mb = screen.get_width() * screen.get_height() * screen.get_bytesize() / 1e6
+
+    def fill():
+        screen.fill(WHITE)
+
+    def copy():
+        background.copy()
+
+    def blit():
+        screen.blit(background, (0, 0))
+
+    def frame():
+        screen.blit(background.copy(), (0, 0))
+        pygame.display.flip()
+
+    results = []
+    for name, op in [('fill', fill), ('copy', copy), ('blit', blit), ('flip', pygame.display.flip), ('frame', frame)]:
+        count = 0
+        started = clock()
+        deadline = started + secs
+        while True:
+            op()
+            count += 1
+            now = clock()
+            if now >= deadline:
+                break
+        rate = count / (now - started)
+        results.append((name, rate, rate * frame_mb))
+    screen.blit(background, (0, 0))
+    pygame.display.flip()
+    return results
+
 
-    # FIXME TODO delete temp_filename
+def log_display_benchmark(screen, results):
+    for name, rate, mb in results:
+        log.info('display_benchmark', op=name, per_sec=rate, mb_per_sec=mb,
+                 resolution='%dx%d' % screen.get_size(), depth=screen.get_bitsize())
+
+
+def test_display(clock, screen, font_time, font_text, j):
+    """One page at a time: help, colour fills for dead pixels,
+    gradients, a tear test bar and the display benchmark.  A factory
+    run only runs a short benchmark, the pages need someone looking"""
+    if factory:
+        criterion = 'frame rate %d/s' % FACTORY_DISPLAY_FPS
+        factory.require([criterion])
+        results = display_benchmark(screen, FACTORY_BENCH_SECS)
+        log_display_benchmark(screen, results)
+        for name, rate, mb in results:
+            factory.note('%s %.0f/s %.1f MB/s' % (name, rate, mb))
+            if name == 'frame' and rate >= FACTORY_DISPLAY_FPS:
+                factory.met(criterion)
+        return
+    my_rect = screen.get_rect()
+    pages = ['help', BLACK, WHITE, RED, GREEN, BLUE, 'gradients', 'tear', 'benchmark']
+    page = 0
+    gradients = None
+    bar_x = 0
+    bar_width = max(8, my_rect.width / 30)
+    benchmark_text = None
+
+    help_surface = pygame.Surface(my_rect.size, 0, screen)
+    help_surface.fill(BLACK)
+    text_str = '''Display Test
+    A/Right=next page
+    B/Left=previous page
+    SELECT=quit
+    Pages: black, white, red, green, blue fills,
+    gradients, tear test bar, benchmark'''
+    rendered_text = render_textrect(text_str, font_text, my_rect, WHITE, surface=help_surface)
+    if rendered_text:
+        help_surface.blit(rendered_text, my_rect.topleft)
+
+    scheduler = FrameScheduler(clock, 60)  # 60 times a second at most
+    profiler.start('test_display')
+    keepGoing = True
+    while keepGoing:
+        # the tear test bar moves every frame
+        events = scheduler.events(active=pages[page] == 'tear', timeout=clock_timeout())
+        for event in events:
+            if event.type == pygame.QUIT:
+                keepGoing = False  # Quit
+            elif event.type == pygame.KEYDOWN:
+                if event.key == BTN_SELECT:
+                    keepGoing = False  # Quit
+                elif event.key in (BTN_A, BTN_DPAD_RIGHT):
+                    page = (page + 1) % len(pages)
+                elif event.key in (BTN_B, BTN_DPAD_LEFT):
+                    page = (page - 1) % len(pages)
+        profiler.mark('update')
+
+        current = pages[page]
+        if current == 'help':
+            screen.blit(help_surface, (0, 0))
+        elif current == 'gradients':
+            if gradients is None:
+                gradients = gradient_surface(my_rect.size, screen)
+            screen.blit(gradients, (0, 0))
+        elif current == 'tear':
+            # tearing shows as the bar breaking up
+            screen.fill(BLACK)
+            bar_x = (bar_x + bar_width / 2) % my_rect.width
+            screen.fill(WHITE, (bar_x, 0, bar_width, my_rect.height))
+        elif current == 'benchmark':
+            if benchmark_text is None:
+                screen.fill(BLACK)
+                screen.blit(text_cache.render(font_text, 'Running display benchmark...', WHITE), (0, 0))
+                pygame.display.flip()
+                results = display_benchmark(screen)
+                log_display_benchmark(screen, results)
+                benchmark_text = '''Display %dx%d %d bit''' % (my_rect.width, my_rect.height, screen.get_bitsize())
+                for name, rate, mb in results:
+                    benchmark_text += '''
+    %s %.0f/s %.1f MB/s''' % (name, rate, mb)
+            screen.fill(BLACK)
+            rendered_text = render_textrect(benchmark_text, font_text, my_rect, WHITE, surface=screen)
+            if rendered_text:
+                screen.blit(rendered_text, my_rect.topleft)
+        else:
+            screen.fill(current)
+        profiler.draw(screen)
+        profiler.mark('blit')
+        pygame.display.flip()
+        profiler.mark('flip')
+        profiler.end_frame()
 
 
 analog_deadzone = 0.01  # basically error margin to ignore
 def test_buttons(clock, screen, font_time, font_text, j):
-    test_hardware = dumb_system_id()
+    test_hardware = system_profile()
     image_filename = test_hardware['background']
-    test_buttons = test_hardware['test_buttons']
     
     my_rect = screen.get_rect()
+    test_buttons = layout(my_rect.size).button_rects(test_hardware)
     no_buttons_pressed = pygame.time.get_ticks()
     
-    try:
-        # NOTE image needs to match screen res
-        # TODO handle images too small/large
-        background = pygame.image.load(image_filename)
-        background = background.convert()
-    except pygame.error:
-        background = pygame.Surface(my_rect.size)
+    background = assets.get(image_filename, my_rect.size)
+    if background is None:
+        background = assets.get(None, my_rect.size).copy()
         # draw one pixel line around edge
         pygame.draw.rect(background, BOX_OUTLINE, my_rect, 1)
+    else:
+        background = background.copy()  # boxes are drawn onto it
 
-    bg = background.copy()
     # TODO? Display system name test_hardware['name']
-    time_surface, textRect = get_time_surface(bg, font_time)
-    bg.blit(time_surface, textRect)
-    
     for x in test_buttons:
         box_details = test_buttons[x]
         pygame.draw.rect(background, BOX_OUTLINE, box_details)
+    if factory:
+        # pass once every button that sends a key was pressed and released
+        button_names = dict([(key, name) for name, key in test_hardware['keys'].items() if key])
+        criteria = dict([(key, 'button %s' % button_names.get(key, key_name(key))) for key in test_buttons if key > 0])
+        factory.require(sorted(criteria.values()))
+        held = set()
+    if DIRTY_RECTS:
+        dirty = DirtyRects(screen, background)
+        screen.blit(background, (0, 0))
+        pygame.display.flip()
+    scheduler = FrameScheduler(clock, 60)  # 60 times a second at most
+    profiler.start('test_buttons')
+    stick_active = False
     keepGoing = True
     really_quit = False
     while keepGoing:
-        #clock.tick(4)  # 4 times a second
-        clock.tick(60)  # 60 times a second
-        bg = background.copy()
+        # measuring latency polls every frame, SDL 1.2's event wait sleeps
+        # 10 ms between polls and the time a woken up wait() returns says
+        # nothing about when the key was queued
+        events = scheduler.events(active=stick_active or LATENCY_MODE, timeout=clock_timeout())
+        pressed = []  # (key, input time) shown by this frame, for LATENCY_MODE
         # update an on screen clock to show activity (and not hung)
         # TODO replace with a count down timer and have button test auto quit?
-        time_surface, textRect = get_time_surface(bg, font_time)
-        bg.blit(time_surface, textRect)
-        for event in pygame.event.get(): 
+        overlays = []  # (name, text, surface, rect) drawn over background
+        time_str = get_time_str()
+        time_surface, textRect = get_time_surface(background, font_time, time_str)
+        overlays.append(('clock', time_str, time_surface, textRect))
+        if LATENCY_MODE:
+            text_y = textRect.bottom
+            for name, key in (('latency0', latency_stats.last_key), ('latency1', None)):
+                latency_str = latency_stats.summary(key)
+                text = text_cache.render(font_text, latency_str, WHITE)
+                textRect = text.get_rect()
+                textRect.centerx = background.get_rect().centerx
+                textRect.top = text_y
+                overlays.append((name, latency_str, text, textRect))
+                text_y = textRect.bottom
+        for event in events: 
             if event.type == pygame.QUIT:
                 keepGoing = False  # Quit
                 really_quit = True
@@ -399,9 +2209,14 @@ def test_buttons(clock, screen, font_time, font_text, j):
                     else:
                         # OpenDingux hack
                         pygame.draw.rect(background, RED, box_details)
+                    if DIRTY_RECTS:
+                        dirty.restore(box_details)
+                    pressed.append((event.key, getattr(event, 'timestamp', None) or scheduler.earliest))
+                    if factory:
+                        held.add(event.key)
                 except KeyError:
                     # TODO display to screen too?
-                    print 'WARNING Unsupported button/key pressed', event.key
+                    log.warning('unsupported_key', key=event.key, state='pressed')
                 if ESCAPE_IS_QUIT and event.key == pygame.locals.K_ESCAPE:
                     # FIXME better quit option, I'm tempted to NOT have one and let OS do it but screen clean up under OpenDingux is not great when abnormally terminating processes
                     keepGoing = False  # Quit
@@ -409,12 +2224,17 @@ def test_buttons(clock, screen, font_time, font_text, j):
                 try:
                     box_details = test_buttons[event.key]
                     pygame.draw.rect(background, PRESSED_DONE, box_details)
+                    if DIRTY_RECTS:
+                        dirty.restore(box_details)
+                    if factory and event.key in held and event.key in criteria:
+                        factory.met(criteria[event.key])
                 except KeyError:
-                    print 'WARNING Unsupported button/key released', event.key
+                    log.warning('unsupported_key', key=event.key, state='released')
             else:
-                print 'WARNING unknown event occurred'
+                log.warning('unknown_event', type=pygame.event.event_name(event.type))
             
         # Joystick
+        stick_active = False
         if j:
             # FIXME this is dirty... TODO use render_textrect() and check ALL Joystick axis/buttons
             jstick_str = ''
@@ -422,13 +2242,13 @@ def test_buttons(clock, screen, font_time, font_text, j):
             axisread = j.get_axis(i)
             if abs(axisread) > analog_deadzone:
                 no_buttons_pressed = pygame.time.get_ticks()
+                stick_active = True
                 jstick_str = 'Axis %i reads %.2f' % (i, axisread)
-            text = font_text.render(jstick_str, True, WHITE)
+            text = text_cache.render(font_text, jstick_str, WHITE)
             textRect = text.get_rect()
-            textRect.centerx = bg.get_rect().centerx
-            textRect.centery = bg.get_rect().bottom - textRect.height
-            if jstick_str:
-                bg.blit(text, textRect)
+            textRect.centerx = background.get_rect().centerx
+            textRect.centery = background.get_rect().bottom - textRect.height
+            overlays.append(('axis0', jstick_str, text if jstick_str else None, textRect))
             temp_y = textRect.centery
 
             jstick_str = ''
@@ -436,201 +2256,330 @@ def test_buttons(clock, screen, font_time, font_text, j):
             axisread = j.get_axis(i)
             if abs(axisread) > analog_deadzone:
                 no_buttons_pressed = pygame.time.get_ticks()
+                stick_active = True
                 jstick_str = 'Axis %i reads %.2f' % (i, axisread)
-            text = font_text.render(jstick_str, True, WHITE)
+            text = text_cache.render(font_text, jstick_str, WHITE)
             textRect = text.get_rect()
-            textRect.centerx = bg.get_rect().centerx
+            textRect.centerx = background.get_rect().centerx
             textRect.centery = temp_y - textRect.height
-            if jstick_str:
-                bg.blit(text, textRect)
+            overlays.append(('axis1', jstick_str, text if jstick_str else None, textRect))
         else:
             # no joystick
             jstick_str = 'no joystick found'
-            text = font_text.render(jstick_str, True, WHITE)
+            text = text_cache.render(font_text, jstick_str, WHITE)
             textRect = text.get_rect()
-            textRect.centerx = bg.get_rect().centerx
-            textRect.centery = bg.get_rect().bottom - textRect.height
-            if jstick_str:
-                bg.blit(text, textRect)
+            textRect.centerx = background.get_rect().centerx
+            textRect.centery = background.get_rect().bottom - textRect.height
+            overlays.append(('axis0', jstick_str, text, textRect))
+        if PROFILE_OVERLAY:
+            overlays.append(('profile',) + profiler.overlay(background.get_rect()))
+        profiler.mark('update')
 
-        screen.blit(bg, (0, 0))
-        pygame.display.flip()
+        if DIRTY_RECTS:
+            for name, key, surface, rect in overlays:
+                dirty.overlay(name, key, surface, rect)
+            profiler.mark('blit')
+            submitted = time.time()
+            dirty.flip()
+        else:
+            bg = background.copy()
+            profiler.mark('background')
+            for name, key, surface, rect in overlays:
+                if surface:
+                    bg.blit(surface, rect)
+            screen.blit(bg, (0, 0))
+            profiler.mark('blit')
+            submitted = time.time()
+            pygame.display.flip()
+        profiler.mark('flip')
+        profiler.end_frame()
+        if LATENCY_MODE:
+            for key, input_time in pressed:
+                latency_stats.add(key, input_time, scheduler.fetched, submitted)
+        if factory and factory.passed():
+            keepGoing = False  # no need to wait for the timeout
         if not ESCAPE_IS_QUIT:
             if (pygame.time.get_ticks() - no_buttons_pressed) >= TEST_TIMEOUT:
                 keepGoing = False  # Quit
+    if LATENCY_MODE:
+        latency_stats.export(LATENCY_FILE)
 
 
-def test_analog1(clock, screen, font_time, font_text, j):
-    test_hardware = dumb_system_id()
-    image_filename = test_hardware['background']
-    
-    my_rect = screen.get_rect()
-    no_buttons_pressed = pygame.time.get_ticks()
-    
-    try:
-        # NOTE image needs to match screen res
-        # TODO handle images too small/large
-        background = pygame.image.load(image_filename)
-        background = background.convert()
-    except pygame.error:
-        background = pygame.Surface(my_rect.size)
+class AnalogSampler(object):
+    """Samples every axis and button of a joystick into a ring buffer,
+    independently of how often the screen is redrawn.
 
-    bg = background.copy()
-    screen_centerx = bg.get_rect().centerx
-    screen_centery = bg.get_rect().centery
-    # draw one pixel line around edge of analog display range box
-    #box_factor = 1
-    box_factor = 2  # 1/2 (0.5)
-    #box_factor = 3  # 1/3 (0.33)
-    box_factor = 100 / box_factor
-    pygame.draw.rect(background, BOX_OUTLINE, ((screen_centerx - 1) - box_factor, (screen_centery - 1) - box_factor, (box_factor * 2) + 3, (box_factor * 2) + 3), 1)
-    num_axes = 0
-    if j:
-        num_axes = j.get_numaxes()
-        #num_axes = 2  # DEBUG pretend to be gcw0
+    SDL only refreshes joystick state when events are pumped on the
+    main thread, so instead of a thread the sampler uses the time a
+    frame loop would otherwise sleep in clock.tick(), see run_until().
+    Each record in the ring is [timestamp, axis 0..n, button 0..m]
+    (monotonic_clock() timestamps), the renderer only looks at the
+    latest state in axes/buttons.
+    """
 
-    # TODO? Display system name test_hardware['name']
-    time_to_quit = TEST_TIMEOUT - (pygame.time.get_ticks() - no_buttons_pressed)
-    time_surface, textRect = get_countdown_surface(bg, font_time, time_to_quit)
-    bg.blit(time_surface, textRect)
-    
-    keepGoing = True
-    really_quit = False
-    #pygame.key.set_repeat(int(1000 * 0.1), int(1000 * 0.1))
-    #pygame.key.set_repeat(1, 50)
-    #pygame.key.set_repeat(40, 30)
-    pygame.key.set_repeat(500, 30)
-    global analog_deadzone
-    while keepGoing:
-        #clock.tick(4)  # 4 times a second
-        clock.tick(60)  # 60 times a second
-        bg = background.copy()
-        # update an on screen clock to show activity (and not hung)
-        # TODO replace with a count down timer and have button test auto quit?
-        time_to_quit = TEST_TIMEOUT - (pygame.time.get_ticks() - no_buttons_pressed)
-        time_surface, textRect = get_countdown_surface(bg, font_time, time_to_quit)
-        bg.blit(time_surface, textRect)
-        for event in pygame.event.get(): 
-            if event.type == pygame.QUIT:
-                keepGoing = False  # Quit
-                really_quit = True
-            elif event.type == pygame.KEYDOWN:
-                no_buttons_pressed = pygame.time.get_ticks()
-                if event.key in [pygame.locals.K_UP, BTN_A,  pygame.locals.K_a]:
-                    analog_deadzone += 0.01
-                    analog_deadzone = min(analog_deadzone, 1.0)
-                elif event.key in [pygame.locals.K_DOWN, BTN_B, ]:
-                    analog_deadzone -= 0.01
-                    analog_deadzone = max(analog_deadzone, 0.0)
-            elif event.type == pygame.KEYUP:
-                if event.key == pygame.locals.K_ESCAPE:
-                    keepGoing = False  # Quit
-                elif event.key in [pygame.locals.K_RIGHT, BTN_X, ]:
-                    analog_deadzone += 0.01
-                    analog_deadzone = min(analog_deadzone, 1.0)
-                elif event.key in [pygame.locals.K_LEFT, BTN_Y, ]:
-                    analog_deadzone -= 0.01
-                    analog_deadzone = max(analog_deadzone, 0.0)
-        
-        # Joystick
-        if j:
-            if num_axes == 2:
-                axis_x, axis_y = 0, 0
-                jstick_str = ''
-                i = 0
-                axisread = j.get_axis(i)
-                if abs(axisread) > analog_deadzone:
-                    axis_x = int(axisread * box_factor)
-                    no_buttons_pressed = pygame.time.get_ticks()
-                    jstick_str = 'Axis %i reads %.2f' % (i, axisread)
-                text = font_text.render(jstick_str, True, WHITE)
-                textRect = text.get_rect()
-                textRect.centerx = bg.get_rect().centerx
-                textRect.centery = bg.get_rect().bottom - textRect.height
-                if jstick_str:
-                    bg.blit(text, textRect)
-                temp_y = textRect.centery
+    def __init__(self, j, size=4096, rate=None):
+        self.j = j
+        self.num_axes = j.get_numaxes()
+        self.num_buttons = j.get_numbuttons()
+        self.width = 1 + self.num_axes + self.num_buttons
+        self.size = size
+        if rate is None:
+            rate = ANALOG_SAMPLE_RATE
+        self.rate = rate
+        self.clock = monotonic_clock()
+        self.buffer = array('d', [0.0]) * (size * self.width)
+        self.count = 0  # samples taken so far, newest is count - 1
+        self.axes = [0.0] * self.num_axes
+        self.buttons = [0] * self.num_buttons
 
-                jstick_str = ''
-                i = 1
-                axisread = j.get_axis(i)
-                if abs(axisread) > analog_deadzone:
-                    axis_y = int(axisread * box_factor)
-                    no_buttons_pressed = pygame.time.get_ticks()
-                    jstick_str = 'Axis %i reads %.2f' % (i, axisread)
-                text = font_text.render(jstick_str, True, WHITE)
-                textRect = text.get_rect()
-                textRect.centerx = bg.get_rect().centerx
-                textRect.centery = temp_y - textRect.height
-                if jstick_str:
-                    bg.blit(text, textRect)
-                pygame.draw.rect(bg, RED, ((screen_centerx - 1) + axis_x, (screen_centery - 1) + axis_y, 3, 3))
-                text = font_text.render('Deadzone %.2f' % analog_deadzone, True, WHITE)
-                textRect = text.get_rect()
-                textRect.left = 5
-                textRect.top = 30
-                bg.blit(text, textRect)
-            else:
-                jstick_str = ''
-                for i in range(0, j.get_numaxes()):
-                    axisread = j.get_axis(i)
-                    if abs(axisread) > analog_deadzone:
-                        no_buttons_pressed = pygame.time.get_ticks()
-                        jstick_str = jstick_str +'\n' + 'Axis %i reads %.2f' % (i, axisread)
-                for i in range(0, j.get_numbuttons()):
-                    buttonread = j.get_button(i)
-                    if buttonread != 0:
-                        no_buttons_pressed = pygame.time.get_ticks()
-                        jstick_str = jstick_str +'\n' + 'Button %i reads %i' % (i, buttonread)
-                if jstick_str:
-                    rendered_text = render_textrect(jstick_str, font_text, my_rect, WHITE, surface=None)
-                    if rendered_text:
-                        bg.blit(rendered_text, my_rect.topleft)
-        else:
-            # no joystick
-            jstick_str = 'no joystick found'
-            text = font_text.render(jstick_str, True, WHITE)
-            textRect = text.get_rect()
-            textRect.centerx = bg.get_rect().centerx
-            textRect.centery = bg.get_rect().bottom - textRect.height
-            if jstick_str:
-                bg.blit(text, textRect)
+    def poll(self):
+        """Take one sample"""
+        j = self.j
+        buffer = self.buffer
+        offset = (self.count % self.size) * self.width
+        buffer[offset] = self.clock()
+        offset += 1
+        axes = self.axes
+        for i in range(self.num_axes):
+            axes[i] = buffer[offset + i] = j.get_axis(i)
+        offset += self.num_axes
+        buttons = self.buttons
+        for i in range(self.num_buttons):
+            buttons[i] = j.get_button(i)
+            buffer[offset + i] = buttons[i]
+        self.count += 1
+
+    def run_until(self, deadline):
+        """Sample at self.rate until time.time() reaches deadline,
+        at least once."""
+        if not self.rate:
+            pygame.event.pump()
+            self.poll()
+            return
+        interval = 1.0 / self.rate
+        while True:
+            pygame.event.pump()
+            self.poll()
+            now = time.time()
+            if now >= deadline:
+                break
+            time.sleep(min(interval, deadline - now))
+
+    def first(self, since):
+        """Oldest sample number still in the ring from since onwards"""
+        return max(since, self.count - self.size)
+
+    def axis(self, n, i):
+        """Value of axis i in sample number n"""
+        return self.buffer[(n % self.size) * self.width + 1 + i]
+
+    def button(self, n, i):
+        """Value of button i in sample number n"""
+        return self.buffer[(n % self.size) * self.width + 1 + self.num_axes + i]
+
+    def timestamp(self, n):
+        return self.buffer[(n % self.size) * self.width]
+
+    def sample_rate(self, since):
+        """Measured samples per second from sample number since"""
+        first = self.first(since)
+        last = self.count - 1
+        if last <= first:
+            return 0.0
+        elapsed = self.timestamp(last) - self.timestamp(first)
+        if elapsed <= 0:
+            return 0.0
+        return (last - first) / elapsed
+
+
+CAPTURE_MAGIC = 'HWTJ'
+CAPTURE_VERSION = 1
+# magic, version, header size, axes, buttons, record size, name length
+CAPTURE_HEADER = struct.Struct('<4sHHHHHH')
 
-        bg.set_at((screen_centerx, screen_centery), WHITE)  # draw single pixel dot at center
 
-        screen.blit(bg, (0, 0))
-        pygame.display.flip()
-        if not ESCAPE_IS_QUIT:
-            if time_to_quit <= 0:
-                keepGoing = False  # Quit
-    pygame.key.set_repeat()
+class SampleRecorder(object):
+    """Appends every AnalogSampler sample to a capture file.
 
-def test_analog2(clock, screen, font_time, font_text, j):
-    """Tests second joystick (i.e. #1, #0 is the first one).
-    On GCW0 device this is the gsensor if the gsensor userspace driver
-    has been successfully installed and ran.
+    Call flush() at least once per ring (AnalogSampler size) of samples,
+    e.g. every frame, memory use stays the same however long the capture.
+    The file is fixed width little endian, so it can be memory mapped
+    on a PC, see open_capture():
+
+        header  CAPTURE_HEADER then the joystick name (UTF-8), zero
+                padded to a multiple of 8 bytes (header size)
+        records d   monotonic timestamp in seconds
+                h   per axis, value * 32767
+                Q   buttons, bit n set while button n is pressed
     """
-    test_hardware = dumb_system_id()
-    image_filename = test_hardware['background']
-    
+
+    def __init__(self, sampler, filename, name=None):
+        self.sampler = sampler
+        self.filename = filename
+        if name is None:
+            name = sampler.j.get_name()
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.record = struct.Struct('<d%dhQ' % sampler.num_axes)
+        # one ring full of packed records, reused by every flush()
+        self.chunk = bytearray(self.record.size * sampler.size)
+        self.written = sampler.count  # next sample number to write
+        self.lost = 0  # samples overwritten in the ring before a flush()
+        header_size = CAPTURE_HEADER.size + len(name)
+        header_size += -header_size % 8
+        header = CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, header_size,
+                                     sampler.num_axes, sampler.num_buttons,
+                                     self.record.size, len(name)) + name
+        self.f = open(filename, 'wb')
+        self.f.write(header.ljust(header_size, '\0'))
+
+    def flush(self):
+        """Write the samples taken since the last flush()"""
+        sampler = self.sampler
+        first = sampler.first(self.written)
+        self.lost += first - self.written
+        num_axes = sampler.num_axes
+        buttons_offset = 1 + num_axes
+        ring = sampler.buffer
+        values = [0] * (num_axes + 2)  # timestamp, axes, button bits
+        pack_into = self.record.pack_into
+        chunk = self.chunk
+        offset = 0
+        for n in range(first, sampler.count):
+            base = (n % sampler.size) * sampler.width
+            values[0] = ring[base]
+            for i in range(num_axes):
+                values[1 + i] = int(ring[base + 1 + i] * 32767)
+            bits = 0
+            for i in range(sampler.num_buttons):
+                if ring[base + buttons_offset + i]:
+                    bits |= 1 << i
+            values[-1] = bits
+            pack_into(chunk, offset, *values)
+            offset += self.record.size
+        if offset:
+            self.f.write(buffer(chunk, 0, offset))
+        self.written = sampler.count
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        if self.lost:
+            log.warning('capture_lost_samples', file=self.filename, lost=self.lost)
+
+
+def capture_filename(directory, j):
+    """New capture file name in directory for joystick j"""
+    name = ''.join([c if c.isalnum() else '_' for c in j.get_name()])
+    return os.path.join(directory, 'analog-%s-%s.hwtj' % (name, time.strftime('%Y%m%d-%H%M%S')))
+
+
+def open_capture(filename):
+    """Memory map a SampleRecorder capture file (on a PC, needs NumPy).
+    Returns (joystick name, numpy record array with fields 'time',
+    'axes' and 'buttons')"""
+    import numpy
+    f = open(filename, 'rb')
     try:
-        j = pygame.joystick.Joystick(1)
-        j.init()
-        print 'Initialized Joystick : %s' % j.get_name()
-    except pygame.error:
-        j = None
-    # open number 2 joystick (on GCW) gsensor driver stick)
+        magic, version, header_size, num_axes, num_buttons, record_size, name_length = CAPTURE_HEADER.unpack(f.read(CAPTURE_HEADER.size))
+        name = f.read(name_length).decode('utf-8')
+    finally:
+        f.close()
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError('%s is not a version %d capture file' % (filename, CAPTURE_VERSION))
+    dtype = numpy.dtype([('time', '<f8'), ('axes', '<i2', (num_axes,)), ('buttons', '<u8')])
+    assert dtype.itemsize == record_size
+    return name, numpy.memmap(filename, dtype=dtype, mode='r', offset=header_size)
+
+
+def noise_stats(sampler, since):
+    """Per axis (mean, standard deviation, max excursion from the mean)
+    of the samples taken from sample number since"""
+    first = sampler.first(since)
+    count = sampler.count - first
+    if count <= 0:
+        return []
+    if HAVE_NUMPY:
+        import numpy
+        ring = numpy.frombuffer(sampler.buffer, dtype=numpy.float64).reshape(sampler.size, sampler.width)
+        axes = ring[numpy.arange(first, sampler.count) % sampler.size, 1:1 + sampler.num_axes]
+        mean = axes.mean(axis=0)
+        excursion = numpy.abs(axes - mean).max(axis=0)
+        return zip(mean.tolist(), axes.std(axis=0).tolist(), excursion.tolist())
+    stats = []
+    for i in range(sampler.num_axes):
+        values = [sampler.axis(n, i) for n in range(first, sampler.count)]
+        mean = sum(values) / count
+        std = (sum([(value - mean) ** 2 for value in values]) / count) ** 0.5
+        stats.append((mean, std, max([abs(value - mean) for value in values])))
+    return stats
+
+
+def calibrate(stats):
+    """Proposed calibration for noise_stats() of a resting stick, a dict
+    of deadzone (applied after centring) and per axis centre offsets"""
+    excursion = max([axis_stats[2] for axis_stats in stats] or [0.0])
+    deadzone = min(1.0, ceil(excursion * CALIBRATE_MARGIN * 100) / 100.0)
+    return {
+        'deadzone': deadzone,
+        'offsets': [axis_stats[0] for axis_stats in stats],
+        'noise': [{'mean': mean, 'std': std, 'excursion': excursion} for mean, std, excursion in stats],
+        'samples_secs': CALIBRATE_SECS,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def load_calibrations(filename=None):
+    """Returns dict of device name -> calibrate() result"""
+    filename = filename or CALIBRATION_FILE
+    try:
+        f = open(filename)
+    except IOError:
+        return {}
+    try:
+        return json.load(f)
+    except ValueError:
+        log.warning('calibration_unreadable', file=filename)
+        return {}
+    finally:
+        f.close()
+
+
+def save_calibration(name, calibration, filename=None):
+    """Store calibration for device name, replacing the file in one go
+    so a power cut can not leave it half written"""
+    filename = filename or CALIBRATION_FILE
+    calibrations = load_calibrations(filename)
+    calibrations[name] = calibration
+    f = open(filename + '.tmp', 'w')
+    json.dump(calibrations, f, indent=4, sort_keys=True)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+
+def analog_test(clock, screen, font_time, font_text, j, skip_missing=True):
+    """Shared analog test engine, shows joystick j (or 'no joystick').
+    A factory run skips the test when j is not a 2 axis stick, unless
+    skip_missing is False (the profile says the hardware is there).
+
+    Two axis sticks get a box plotting the stick position with a trail
+    of every sample taken since the last frame, anything else gets a
+    text list of active axes and buttons.  Start samples the resting
+    stick for CALIBRATE_SECS and sets (and saves) the deadzone and
+    centre for the device.
+    """
+    test_hardware = system_profile()
+    image_filename = test_hardware['background']
     
     my_rect = screen.get_rect()
     no_buttons_pressed = pygame.time.get_ticks()
     
-    try:
-        # NOTE image needs to match screen res
-        # TODO handle images too small/large
-        background = pygame.image.load(image_filename)
-        background = background.convert()
-    except pygame.error:
-        background = pygame.Surface(my_rect.size)
+    background = assets.get(image_filename, my_rect.size)
+    if background is None:
+        background = assets.get(None, my_rect.size)
+    background = background.copy()  # cached surface is shared
 
     bg = background.copy()
     screen_centerx = bg.get_rect().centerx
@@ -639,17 +2588,27 @@ def test_analog2(clock, screen, font_time, font_text, j):
     #box_factor = 1
     box_factor = 2  # 1/2 (0.5)
     #box_factor = 3  # 1/3 (0.33)
-    box_factor = 100 / box_factor
+    screen_layout = layout(my_rect.size)
+    box_factor = screen_layout.pixels(100 / box_factor)
+    # labels go under the countdown, in the order deadzone, sampling rate,
+    # calibrating (recording on the right), spaced by the scaled fonts
+    margin = screen_layout.pixels(5)
+    label_top = font_time.get_linesize()
+    label_height = font_text.get_linesize()
     pygame.draw.rect(background, BOX_OUTLINE, ((screen_centerx - 1) - box_factor, (screen_centery - 1) - box_factor, (box_factor * 2) + 3, (box_factor * 2) + 3), 1)
+    sampler = None
+    recorder = None
     num_axes = 0
     if j:
-        num_axes = j.get_numaxes()
+        sampler = AnalogSampler(j)
+        num_axes = sampler.num_axes
         #num_axes = 2  # DEBUG pretend to be gcw0
+        if RECORD_DIR:
+            recorder = SampleRecorder(sampler, capture_filename(RECORD_DIR, j))
+            log.info('capture_recording', file=recorder.filename)
 
     # TODO? Display system name test_hardware['name']
     time_to_quit = TEST_TIMEOUT - (pygame.time.get_ticks() - no_buttons_pressed)
-    time_surface, textRect = get_countdown_surface(bg, font_time, time_to_quit)
-    bg.blit(time_surface, textRect)
     
     keepGoing = True
     really_quit = False
@@ -657,134 +2616,682 @@ def test_analog2(clock, screen, font_time, font_text, j):
     #pygame.key.set_repeat(1, 50)
     #pygame.key.set_repeat(40, 30)
     pygame.key.set_repeat(500, 30)
-    global analog_deadzone
+    # per joystick like the offsets, the button test keeps the default
+    deadzone = analog_deadzone
+    offsets = [0.0] * num_axes  # centre of each axis, subtracted from readings
+    if factory:
+        if num_axes < 2 and skip_missing:
+            # no stick, or one SDL turns into keys (see --evdev)
+            factory.skip(sampler and '%d axes, need 2' % num_axes or 'no joystick')
+            pygame.key.set_repeat()
+            return
+        factory.require(['joystick found'])
+        if not sampler:
+            factory.note('no joystick')
+            pygame.key.set_repeat()
+            return
+        factory.met('joystick found')
+        if num_axes < 2:
+            factory.note('%d axes, need 2' % num_axes)
+        factory.require(['stick left', 'stick right', 'stick up', 'stick down'])
+    if j:
+        calibration = load_calibrations().get(j.get_name())
+        if calibration and len(calibration['offsets']) == num_axes:
+            deadzone = calibration['deadzone']
+            offsets = calibration['offsets']
+    calibrate_since = None  # sample number calibration started from
+    calibrate_until = 0
+    scheduler = FrameScheduler(clock, 60, sampler)  # 60 times a second at most
+    profiler.start('analog_test')
+    stick_active = False
+    last_sample = 0  # first sample not drawn yet
     while keepGoing:
-        #clock.tick(4)  # 4 times a second
-        clock.tick(60)  # 60 times a second
+        # wake up when the countdown shows the next second, keep
+        # sampling at full rate while recording
+        events = scheduler.events(active=stick_active or recorder is not None or calibrate_since is not None, timeout=time_to_quit % 1000 or 1000)
+        if recorder:
+            recorder.flush()
         bg = background.copy()
+        profiler.mark('background')
         # update an on screen clock to show activity (and not hung)
         # TODO replace with a count down timer and have button test auto quit?
         time_to_quit = TEST_TIMEOUT - (pygame.time.get_ticks() - no_buttons_pressed)
         time_surface, textRect = get_countdown_surface(bg, font_time, time_to_quit)
         bg.blit(time_surface, textRect)
-        for event in pygame.event.get(): 
+        for event in events: 
             if event.type == pygame.QUIT:
                 keepGoing = False  # Quit
                 really_quit = True
             elif event.type == pygame.KEYDOWN:
                 no_buttons_pressed = pygame.time.get_ticks()
                 if event.key in [pygame.locals.K_UP, BTN_A,  pygame.locals.K_a]:
-                    analog_deadzone += 0.01
-                    analog_deadzone = min(analog_deadzone, 1.0)
+                    deadzone += 0.01
+                    deadzone = min(deadzone, 1.0)
                 elif event.key in [pygame.locals.K_DOWN, BTN_B, ]:
-                    analog_deadzone -= 0.01
-                    analog_deadzone = max(analog_deadzone, 0.0)
+                    deadzone -= 0.01
+                    deadzone = max(deadzone, 0.0)
             elif event.type == pygame.KEYUP:
                 if event.key == pygame.locals.K_ESCAPE:
                     keepGoing = False  # Quit
+                elif event.key == BTN_START and sampler and calibrate_since is None:
+                    calibrate_since = sampler.count
+                    calibrate_until = time.time() + CALIBRATE_SECS
                 elif event.key in [pygame.locals.K_RIGHT, BTN_X, ]:
-                    analog_deadzone += 0.01
-                    analog_deadzone = min(analog_deadzone, 1.0)
+                    deadzone += 0.01
+                    deadzone = min(deadzone, 1.0)
                 elif event.key in [pygame.locals.K_LEFT, BTN_Y, ]:
-                    analog_deadzone -= 0.01
-                    analog_deadzone = max(analog_deadzone, 0.0)
+                    deadzone -= 0.01
+                    deadzone = max(deadzone, 0.0)
         
-        # Joystick
-        if j:
-            if num_axes == 2:
-                axis_x, axis_y = 0, 0
-                jstick_str = ''
-                i = 0
-                axisread = j.get_axis(i)
-                if abs(axisread) > analog_deadzone:
-                    axis_x = int(axisread * box_factor)
-                    no_buttons_pressed = pygame.time.get_ticks()
-                    jstick_str = 'Axis %i reads %.2f' % (i, axisread)
-                text = font_text.render(jstick_str, True, WHITE)
+        if calibrate_since is not None:
+            no_buttons_pressed = pygame.time.get_ticks()
+            if time.time() >= calibrate_until:
+                calibration = calibrate(noise_stats(sampler, calibrate_since))
+                deadzone = calibration['deadzone']
+                offsets = calibration['offsets']
+                save_calibration(j.get_name(), calibration)
+                log.info('calibrated', joystick=j.get_name(), deadzone=deadzone, centre=' '.join(['%+.3f' % offset for offset in offsets]))
+                calibrate_since = None
+            else:
+                text = text_cache.render(font_text, 'Calibrating, do not touch %d' % ceil(calibrate_until - time.time()), RED)
                 textRect = text.get_rect()
                 textRect.centerx = bg.get_rect().centerx
-                textRect.centery = bg.get_rect().bottom - textRect.height
-                if jstick_str:
-                    bg.blit(text, textRect)
-                temp_y = textRect.centery
+                textRect.top = label_top + 2 * label_height
+                bg.blit(text, textRect)
 
-                jstick_str = ''
-                i = 1
-                axisread = j.get_axis(i)
-                if abs(axisread) > analog_deadzone:
-                    axis_y = int(axisread * box_factor)
-                    no_buttons_pressed = pygame.time.get_ticks()
-                    jstick_str = 'Axis %i reads %.2f' % (i, axisread)
-                text = font_text.render(jstick_str, True, WHITE)
-                textRect = text.get_rect()
-                textRect.centerx = bg.get_rect().centerx
-                textRect.centery = temp_y - textRect.height
-                if jstick_str:
-                    bg.blit(text, textRect)
+        # Joystick
+        stick_active = False
+        if sampler:
+            if factory and num_axes >= 2:
+                # every sample counts, a flick to the edge between frames too
+                for n in range(sampler.first(last_sample), sampler.count):
+                    sample_x = sampler.axis(n, 0) - offsets[0]
+                    sample_y = sampler.axis(n, 1) - offsets[1]
+                    if sample_x <= -FACTORY_EDGE:
+                        factory.met('stick left')
+                    elif sample_x >= FACTORY_EDGE:
+                        factory.met('stick right')
+                    if sample_y <= -FACTORY_EDGE:
+                        factory.met('stick up')
+                    elif sample_y >= FACTORY_EDGE:
+                        factory.met('stick down')
+            if num_axes == 2:
+                # trail of every sample since the last frame, shows flicks
+                # and noise a once per frame read would miss
+                trail = []
+                for n in range(sampler.first(last_sample), sampler.count):
+                    sample_x = sampler.axis(n, 0) - offsets[0]
+                    sample_y = sampler.axis(n, 1) - offsets[1]
+                    if abs(sample_x) <= deadzone:
+                        sample_x = 0
+                    if abs(sample_y) <= deadzone:
+                        sample_y = 0
+                    trail.append((screen_centerx + int(sample_x * box_factor), screen_centery + int(sample_y * box_factor)))
+                if len(trail) > 1:
+                    pygame.draw.lines(bg, SAMPLE_TRAIL, False, trail)
+
+                axis_pos = [0, 0]
+                text_y = bg.get_rect().bottom
+                for i in (0, 1):
+                    jstick_str = ''
+                    axisread = sampler.axes[i] - offsets[i]
+                    if abs(axisread) > deadzone:
+                        axis_pos[i] = int(axisread * box_factor)
+                        no_buttons_pressed = pygame.time.get_ticks()
+                        stick_active = True
+                        jstick_str = 'Axis %i reads %.2f' % (i, axisread)
+                    text = text_cache.render(font_text, jstick_str, WHITE)
+                    textRect = text.get_rect()
+                    textRect.centerx = bg.get_rect().centerx
+                    textRect.centery = text_y - textRect.height
+                    if jstick_str:
+                        bg.blit(text, textRect)
+                    text_y = textRect.centery
+                axis_x, axis_y = axis_pos
                 pygame.draw.rect(bg, RED, ((screen_centerx - 1) + axis_x, (screen_centery - 1) + axis_y, 3, 3))
-                text = font_text.render('Deadzone %.2f' % analog_deadzone, True, WHITE)
+                text = text_cache.render(font_text, 'Deadzone %.2f' % deadzone, WHITE)
                 textRect = text.get_rect()
-                textRect.left = 5
-                textRect.top = 30
+                textRect.left = margin
+                textRect.top = label_top
                 bg.blit(text, textRect)
+                if stick_active:
+                    # rounded so the label is not re-rendered every frame
+                    rate = int(sampler.sample_rate(last_sample) / 10) * 10
+                    text = text_cache.render(font_text, 'Sampling %d Hz' % rate, WHITE)
+                    textRect = text.get_rect()
+                    textRect.left = margin
+                    textRect.top = label_top + label_height
+                    bg.blit(text, textRect)
             else:
                 jstick_str = ''
-                for i in range(0, j.get_numaxes()):
-                    axisread = j.get_axis(i)
-                    if abs(axisread) > analog_deadzone:
+                for i, axisread in enumerate(sampler.axes):
+                    axisread -= offsets[i]
+                    if abs(axisread) > deadzone:
                         no_buttons_pressed = pygame.time.get_ticks()
+                        stick_active = True
                         jstick_str = jstick_str +'\n' + 'Axis %i reads %.2f' % (i, axisread)
-                for i in range(0, j.get_numbuttons()):
-                    buttonread = j.get_button(i)
+                for i, buttonread in enumerate(sampler.buttons):
                     if buttonread != 0:
                         no_buttons_pressed = pygame.time.get_ticks()
+                        stick_active = True
                         jstick_str = jstick_str +'\n' + 'Button %i reads %i' % (i, buttonread)
                 if jstick_str:
                     rendered_text = render_textrect(jstick_str, font_text, my_rect, WHITE, surface=None)
                     if rendered_text:
                         bg.blit(rendered_text, my_rect.topleft)
+            last_sample = sampler.count
         else:
             # no joystick
             jstick_str = 'no joystick found'
-            text = font_text.render(jstick_str, True, WHITE)
+            text = text_cache.render(font_text, jstick_str, WHITE)
             textRect = text.get_rect()
             textRect.centerx = bg.get_rect().centerx
             textRect.centery = bg.get_rect().bottom - textRect.height
             if jstick_str:
                 bg.blit(text, textRect)
 
+        if recorder:
+            text = text_cache.render(font_text, 'Recording %d samples' % (sampler.count / 1000 * 1000), RED)
+            textRect = text.get_rect()
+            textRect.right = bg.get_rect().right - margin
+            textRect.top = label_top
+            bg.blit(text, textRect)
+
         bg.set_at((screen_centerx, screen_centery), WHITE)  # draw single pixel dot at center
+        profiler.mark('update')
 
         screen.blit(bg, (0, 0))
+        profiler.draw(screen)
+        profiler.mark('blit')
         pygame.display.flip()
-        if not ESCAPE_IS_QUIT:
+        profiler.mark('flip')
+        profiler.end_frame()
+        if factory and factory.passed():
+            keepGoing = False  # no need to wait for the timeout
+        if not ESCAPE_IS_QUIT and not recorder:
+            # soak captures run until Escape
             if time_to_quit <= 0:
                 keepGoing = False  # Quit
+    if recorder:
+        recorder.close()
     pygame.key.set_repeat()
 
 
-def dumb_system_id():
-    f = open('/proc/cpuinfo')
-    line = f.readline()  # cheat, only read first line and expect it to be in order....
-    f.close()
-    if 'JZ4740' in line:
-        return a320
-    return papk3  # default
+def test_analog1(clock, screen, font_time, font_text, j):
+    analog_test(clock, screen, font_time, font_text, j)
+
+
+def test_analog2(clock, screen, font_time, font_text, j):
+    """Tests second joystick (i.e. #1, #0 is the first one).
+    On GCW0 device this is the gsensor if the gsensor userspace driver
+    has been successfully installed and ran.
+    """
+    # open number 2 joystick (on GCW) gsensor driver stick)
+    j = open_joystick(1)
+    analog_test(clock, screen, font_time, font_text, j, skip_missing=False)
+
+
+def open_fonts():
+    """Returns (font_text, font_time)"""
+    # pygame's default font is what SysFont(None) gives but without font discovery
+    screen_layout = layout()
+    return screen_layout.font(20), screen_layout.font(40)
+
+
+def open_joystick(number=0, evdev=None):
+    """Returns initialized joystick number, None if there is none.
+    The stick of EvdevReader evdev is used instead when it has axes."""
+    if session:
+        return session.joystick(number, evdev)
+    return _open_joystick(number, evdev)
+
+
+def _open_joystick(number, evdev):
+    if evdev and evdev.joystick.get_numaxes():
+        return evdev.joystick
+    if not pygame.joystick.get_init():
+        pygame.joystick.init()
+    try:
+        j = pygame.joystick.Joystick(number)
+        j.init()
+        log.info('joystick_init', number=number, name=j.get_name())
+    except pygame.error:
+        j = None
+    return j
+
+
+##########################################################################
+# Direct evdev input, bypasses SDL's keyboard/joystick handling
+
+
+# struct input_event from linux/input.h, struct timeval is two native longs
+INPUT_EVENT_FORMAT = 'llHHi'
+INPUT_EVENT_SIZE = struct.calcsize(INPUT_EVENT_FORMAT)
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_DROPPED = 3
+ABS_X = 0x00
+ABS_Y = 0x01
+ABS_HAT0X = 0x10  # codes below are stick/wheel/pedal axes
+ABS_MT_SLOT = 0x2f  # codes from here on are multi touch
+ABS_CNT = 0x40
+INPUT_PROP_DIRECT = 0x01  # touchscreen
+INPUT_PROP_ACCELEROMETER = 0x06
+INPUT_PROP_CNT = 0x20
+EVDEV_UNMAPPED = 0x10000  # added to scancodes with no SDL key, outside SDLK range
+
+# OpenDingux kernel keycodes (linux/input.h KEY_*) for the SDL buttons above
+EVDEV_KEYS = {
+    103: BTN_DPAD_UP,  # KEY_UP
+    108: BTN_DPAD_DOWN,  # KEY_DOWN
+    105: BTN_DPAD_LEFT,  # KEY_LEFT
+    106: BTN_DPAD_RIGHT,  # KEY_RIGHT
+    29: BTN_A,  # KEY_LEFTCTRL
+    56: BTN_B,  # KEY_LEFTALT
+    57: BTN_X,  # KEY_SPACE
+    42: BTN_Y,  # KEY_LEFTSHIFT
+    28: BTN_START,  # KEY_ENTER
+    1: BTN_SELECT,  # KEY_ESC
+    15: BTN_LEFT_SHOULDER,  # KEY_TAB
+    14: BTN_RIGHT_SHOULDER,  # KEY_BACKSPACE
+    107: BTN_HOLD,  # KEY_END
+    2: BTN_VOL_DOWN,  # KEY_1
+    3: BTN_VOL_UP,  # KEY_2
+    116: 0,  # KEY_POWER, see 'OpenDingux hack' in test_buttons
+}
+
+# ioctl request numbers, MIPS (and a few others) use a 3 bit direction
+# field with different bits for the directions
+if os.uname()[4].startswith(('mips', 'ppc', 'powerpc', 'sparc', 'alpha')):
+    _IOC_NONE, _IOC_READ, _IOC_WRITE = 1, 2, 4
+    _IOC_DIRSHIFT = 29
+else:
+    _IOC_NONE, _IOC_READ, _IOC_WRITE = 0, 2, 1
+    _IOC_DIRSHIFT = 30
+
+def _IOC(direction, nr, size):
+    return (direction << _IOC_DIRSHIFT) | (size << 16) | (ord('E') << 8) | nr
+
+EVIOCGBIT_ABS = _IOC(_IOC_READ, 0x20 + EV_ABS, ABS_CNT / 8)  # supported ABS_* codes
+EVIOCGRAB = _IOC(_IOC_WRITE, 0x90, 4)  # exclusive access
+EVIOCGNAME = _IOC(_IOC_READ, 0x06, 256)  # device name
+EVIOCGPROP = _IOC(_IOC_READ, 0x09, INPUT_PROP_CNT / 8)  # INPUT_PROP_* bits
+
+def EVIOCGABS(code):
+    return _IOC(_IOC_READ, 0x40 + code, 24)  # struct input_absinfo
+
+_event_unpackers = {}
+
+def decode_input_events(data):
+    """Decodes a buffer of struct input_event in one go. Returns a flat
+    tuple (sec, usec, type, code, value, sec, usec, ...), 5 per event,
+    a trailing partial event is ignored."""
+    count = len(data) // INPUT_EVENT_SIZE
+    try:
+        unpacker = _event_unpackers[count]
+    except KeyError:
+        unpacker = _event_unpackers[count] = struct.Struct(INPUT_EVENT_FORMAT * count)
+    return unpacker.unpack_from(data)
+
+
+class EvdevJoystick(object):
+    """pygame.joystick.Joystick look-alike for one evdev device, fed by
+    an EvdevReader, axis i is the i-th lowest of the device's stick
+    ABS_* codes, values scaled to -1.0 .. 1.0"""
+
+    def __init__(self, name='evdev'):
+        self.name = name
+        self.ranges = {}  # ABS code -> (min, max)
+        self.axes = {}  # ABS code -> axis number
+        self.values = []
+        self.numaxes = 0
+        self.polled = True  # values read since the last wake up event
+
+    def add_axis(self, code, minimum, maximum):
+        if maximum <= minimum:
+            return
+        self.ranges[code] = (minimum, maximum)
+        codes = sorted(self.ranges)
+        self.axes = dict([(axis_code, n) for n, axis_code in enumerate(codes)])
+        self.numaxes = len(codes)
+        self.values = [0.0] * self.numaxes
+
+    def set_axis(self, code, value):
+        """Returns the axis number, None for codes that are not axes"""
+        try:
+            minimum, maximum = self.ranges[code]
+        except KeyError:
+            return None
+        axis = self.axes[code]
+        self.values[axis] = (2.0 * (value - minimum) / (maximum - minimum)) - 1.0
+        return axis
+
+    def init(self):
+        pass
+
+    def quit(self):
+        pass
+
+    def get_name(self):
+        return self.name
+
+    def get_numaxes(self):
+        return self.numaxes
+
+    def get_axis(self, i):
+        self.polled = True
+        return self.values[i]
+
+    def get_numbuttons(self):
+        return 0
+
+    def get_button(self, i):
+        return 0
+
+
+class EvdevReader(threading.Thread):
+    """Reads /dev/input/event* directly on a background thread.
+
+    All devices are read nonblocking behind one select() and decoded in
+    bulk. Keys are posted as pygame KEYDOWN/KEYUP events using the
+    EVDEV_KEYS map (unmapped keys as EVDEV_UNMAPPED + scancode), with
+    the raw scancode, the kernel timestamp (time.time() based) and the
+    device path as extra attributes. Every device with stick axes gets
+    an EvdevJoystick in self.joysticks, self.joystick is the first one
+    that looks like a stick (not an accelerometer or touchscreen).
+    Devices are grabbed so SDL does not see the same presses again.
+    Any readable file of input_event records works, e.g. a FIFO.
+    """
+
+    read_events = 64  # per os.read()
+
+    def __init__(self, paths=None, keymap=EVDEV_KEYS, grab=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if paths is None:
+            paths = sorted(glob.glob('/dev/input/event*'))
+        self.keymap = keymap
+        self.joysticks = {}  # path -> EvdevJoystick
+        self.joystick = None
+        self.devices = {}  # fd -> path
+        self.pending = deque()  # events not yet accepted by SDL's (small) queue
+        self.dropped = 0  # SYN_DROPPED reports, kernel buffer overran
+        self.running = True
+        self.wake_r, self.wake_w = os.pipe()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            self.devices[fd] = path
+            if grab:
+                try:
+                    fcntl.ioctl(fd, EVIOCGRAB, 1)
+                except IOError:
+                    pass  # not an input device (FIFO) or grabbed already
+            self._probe_axes(fd, path)
+        if self.joystick is None:
+            self.joystick = EvdevJoystick()  # no axes, open_joystick() uses SDL's
+
+    def _probe_axes(self, fd, path):
+        try:
+            bits = fcntl.ioctl(fd, EVIOCGBIT_ABS, '\0' * (ABS_CNT / 8))
+        except IOError:
+            return
+        codes = [code for code in range(ABS_CNT) if ord(bits[code / 8]) & (1 << (code % 8))]
+        try:
+            name = fcntl.ioctl(fd, EVIOCGNAME, '\0' * 256).split('\0')[0] or path
+        except IOError:
+            name = path
+        joystick = EvdevJoystick(name)
+        for code in codes:
+            if code < ABS_HAT0X:
+                absinfo = struct.unpack('6i', fcntl.ioctl(fd, EVIOCGABS(code), '\0' * 24))
+                joystick.add_axis(code, absinfo[1], absinfo[2])
+        if not joystick.numaxes:
+            return
+        self.joysticks[path] = joystick
+        try:
+            props = fcntl.ioctl(fd, EVIOCGPROP, '\0' * (INPUT_PROP_CNT / 8))
+        except IOError:
+            props = '\0' * (INPUT_PROP_CNT / 8)  # kernel older than 2.6.38
+        prop_bits = [ord(props[prop / 8]) & (1 << (prop % 8)) for prop in (INPUT_PROP_DIRECT, INPUT_PROP_ACCELEROMETER)]
+        stick = ABS_X in joystick.ranges and ABS_Y in joystick.ranges
+        touch = [code for code in codes if code >= ABS_MT_SLOT]
+        if self.joystick is None and stick and not touch and not any(prop_bits):
+            self.joystick = joystick
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_w, 'x')
+
+    def run(self):
+        try:
+            while self.running and self.devices:
+                timeout = None
+                if self.pending:
+                    timeout = 0.01  # SDL queue was full, retry soon
+                readable = select.select(list(self.devices) + [self.wake_r], [], [], timeout)[0]
+                for fd in readable:
+                    if fd in self.devices:
+                        self._read(fd)
+                self._flush()
+        finally:
+            for fd in self.devices:
+                os.close(fd)
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+
+    def _read(self, fd):
+        path = self.devices[fd]
+        while True:
+            try:
+                data = os.read(fd, INPUT_EVENT_SIZE * self.read_events)
+            except OSError, info:
+                if info.errno != errno.EAGAIN:
+                    del self.devices[fd]  # unplugged
+                    os.close(fd)
+                return
+            if not data:
+                del self.devices[fd]  # EOF (FIFO writer went away)
+                os.close(fd)
+                return
+            self.handle(decode_input_events(data), path)
+            if len(data) < INPUT_EVENT_SIZE * self.read_events:
+                return
+
+    def handle(self, values, path=None):
+        """Handle decoded events, see decode_input_events()"""
+        for n in range(0, len(values), 5):
+            sec, usec, ev_type, code, value = values[n:n + 5]
+            if ev_type == EV_KEY:
+                if value == 2:
+                    continue  # autorepeat
+                key = self.keymap.get(code, EVDEV_UNMAPPED + code)
+                if value:
+                    event_type = pygame.KEYDOWN
+                else:
+                    event_type = pygame.KEYUP
+                self.pending.append(pygame.event.Event(event_type, key=key, scancode=code, timestamp=sec + usec / 1000000.0, device=path))
+            elif ev_type == EV_ABS:
+                joystick = self.joysticks.get(path, self.joystick)
+                axis = joystick.set_axis(code, value)
+                if axis is not None and joystick is self.joystick and joystick.polled:
+                    # one wake up until the frame loop reads the values
+                    joystick.polled = False
+                    self.pending.append(pygame.event.Event(pygame.JOYAXISMOTION, joy=-1, axis=axis, value=joystick.values[axis]))
+            elif ev_type == EV_SYN and code == SYN_DROPPED:
+                self.dropped += 1
+
+    def _flush(self):
+        while self.pending:
+            event = self.pending[0]
+            try:
+                pygame.event.post(event)
+            except pygame.error:
+                return  # SDL queue full, keep it for later
+            self.pending.popleft()
+
+##########################################################################
+
+
+##########################################################################
+# Device profiles, one JSON file per handheld in PROFILE_DIR:
+#
+#   name            shown in the log
+#   match           substrings to look for in each detection signal,
+#                   {"cpuinfo": [...], "model": [...], "input": [...]}
+#   default         use this profile when none match
+#   resolution      [width, height] test_buttons are laid out for, and the
+#                   window size on a desktop (see display_resolution())
+#   background      image for the test screens
+#   audio_channels  1 or 2
+#   sensors         extra hardware with a test, e.g. ["gsensor", "mic"]
+#   keys            button name -> pygame key name ("K_LCTRL") for
+#                   buttons not bound like BTN_*, or key number (0 for
+#                   the OpenDingux power slider), null if SDL never sees it
+#   test_buttons    button name -> [x, y, width, height] in the button test,
+#                   pixels at resolution, scaled to the actual display
+
+PROFILE_DIR = 'profiles'
+DEFAULT_KEYS = dict([(name[len('BTN_'):], value) for name, value in globals().items() if name.startswith('BTN_')])
+FALLBACK_PROFILE = {
+    'name': 'Unknown',
+    'match': {},
+    'default': True,
+    'resolution': (480, 272),
+    'background': None,
+    'audio_channels': 2,
+    'sensors': [],
+    'keys': DEFAULT_KEYS,
+    'test_buttons': {},
+}
+
+
+def read_text(filename):
+    """Contents of filename, empty when it can not be read"""
+    try:
+        f = open(filename)
+    except IOError:
+        return ''
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def read_signals():
+    """Detection signals, dict of signal name -> text to match in"""
+    models = []
+    for filename in ('/proc/device-tree/model', '/sys/class/dmi/id/product_name', '/sys/class/dmi/id/board_name'):
+        models.append(read_text(filename).strip('\0\n'))
+    inputs = []
+    for line in read_text('/proc/bus/input/devices').splitlines():
+        if line.startswith('N: Name='):
+            inputs.append(line[len('N: Name='):].strip('"'))
+    return {
+        'cpuinfo': read_text('/proc/cpuinfo'),
+        'model': '\n'.join(models),
+        'input': '\n'.join(inputs),
+    }
+
+
+def load_profile(filename):
+    """Profile dict from a JSON file, with test_buttons keyed by pygame
+    key like the tests expect"""
+    f = open(filename)
+    try:
+        profile = json.load(f)
+    finally:
+        f.close()
+    keys = dict(DEFAULT_KEYS)
+    for button, key in profile.get('keys', {}).items():
+        if isinstance(key, basestring):
+            key = getattr(pygame.locals, key)
+        keys[button] = key
+    profile.setdefault('default', False)
+    for name, value in FALLBACK_PROFILE.items():
+        profile.setdefault(name, value)
+    profile['resolution'] = tuple(profile['resolution'])
+    width, height = [float(length) for length in profile['resolution']]
+    test_buttons = {}
+    unbound = 0
+    for button, rect in profile['test_buttons'].items():
+        if button not in keys:
+            raise ValueError('no key for button %s' % button)
+        key = keys[button]
+        if key is None:
+            unbound -= 1  # shown but never lit, no key event has a negative key
+            key = unbound
+        x, y, w, h = rect
+        test_buttons[key] = (x / width, y / height, w / width, h / height)  # normalized, see Layout.rect()
+    profile['keys'] = keys
+    profile['test_buttons'] = test_buttons
+    profile['filename'] = filename
+    return profile
+
+
+def load_profiles(directory=None):
+    """All profiles in directory (default PROFILE_DIR), in file name order"""
+    profiles = []
+    for filename in sorted(glob.glob(os.path.join(directory or PROFILE_DIR, '*.json'))):
+        try:
+            profiles.append(load_profile(filename))
+        except (IOError, ValueError, AttributeError), info:
+            log.warning('profile_ignored', file=filename, error=str(info))
+    return profiles
+
+
+def match_profile(profiles, signals):
+    """Profile matching the most signals, the default one if none match"""
+    best = None
+    best_score = 0
+    for profile in profiles:
+        score = 0
+        for signal, patterns in profile['match'].items():
+            text = signals.get(signal, '')
+            for pattern in patterns:
+                if pattern in text:
+                    score += 1
+                    break
+        if score > best_score:
+            best = profile
+            best_score = score
+    if best is None:
+        for profile in profiles:
+            if profile['default']:
+                return profile
+        return FALLBACK_PROFILE
+    return best
+
+
+_profile = None
+
+def system_profile():
+    """Profile of the device we run on, detected on first call"""
+    global _profile
+    if _profile is None:
+        _profile = match_profile(load_profiles(), read_signals())
+        log.info('device_profile', name=_profile['name'])
+    return _profile
 
 ##########################################################################
 
 
-def sinInterpolation(start, end, steps=30):
-    values = [start]
-    delta = end - start
-    for i in range(1, steps):
-        n = (pi / 2.0) * (i / float(steps - 1))
-        values.append(start + delta * sin(n))
-    return values
+# menu animation, eased with a quarter sine and looked up in tables so a
+# frame only does arithmetic
+MENU_ROTATION_SECS = 0.5  # was 45 frames at 90 fps
+EASE_STEPS = 256
+EASE_TABLE = array('d', [sin((pi / 2.0) * (i / float(EASE_STEPS - 1))) for i in range(EASE_STEPS)])
+TRIG_STEPS = 4096  # ~0.2 pixel error on a 120 pixel radius
+TRIG_SCALE = TRIG_STEPS / (2 * pi)
+COS_TABLE = array('d', [cos(2 * pi * i / TRIG_STEPS) for i in range(TRIG_STEPS)])
+SIN_TABLE = array('d', [sin(2 * pi * i / TRIG_STEPS) for i in range(TRIG_STEPS)])
 
 
 class RotatingMenu(object):
-    def __init__(self, x, y, radius, arc=pi * 2, defaultAngle=0, wrap=False):
+    def __init__(self, x, y, radius, arc=pi * 2, defaultAngle=0, wrap=False, duration=MENU_ROTATION_SECS):
         """
         @param x:
             The horizontal center of this menu in pixels.
@@ -805,6 +3312,10 @@ class RotatingMenu(object):
         @param wrap:
             Whether the menu should select the first item after the last one
             or stop.
+        
+        @param duration:
+            Seconds a rotation to the selected item takes, whatever the
+            frame rate.
         """
         self.x = x
         self.y = y
@@ -812,12 +3323,16 @@ class RotatingMenu(object):
         self.arc = arc
         self.defaultAngle = defaultAngle
         self.wrap = wrap
+        self.duration = duration
         
         self.rotation = 0
         self.rotationTarget = 0
-        self.rotationSteps = []  # Used for interpolation
+        self.rotationStart = 0  # Used for interpolation
+        self.rotationFrom = 0
+        self.rotating = False
         
         self.items = []
+        self.offsets = array('d')  # angle of each item, relative to the selected one
         self.selectedItem = None
         self.selectedItemNumber = 0
     
@@ -825,8 +3340,10 @@ class RotatingMenu(object):
         self.items.append(item)
         if len(self.items) == 1:
             self.selectedItem = item
+        count = max(len(self.items) - 1, 1)
+        self.offsets = array('d', [self.defaultAngle + self.arc * (i / float(count)) for i in range(len(self.items))])
     
-    def selectItem(self, itemNumber):
+    def selectItem(self, itemNumber, now=None):
         if self.wrap == True:
             if itemNumber > len(self.items) - 1:
                 itemNumber = 0
@@ -844,23 +3361,33 @@ class RotatingMenu(object):
         
         self.rotationTarget = - self.arc * (itemNumber / float(len(self.items) - 1))
         
-        self.rotationSteps = sinInterpolation(self.rotation,
-                                              self.rotationTarget, 45)
+        self.rotationFrom = self.rotation
+        self.rotationStart = now if now is not None else time.time()
+        self.rotating = True
     
     def rotate(self, angle):
         """@param angle: The angle in radians by which the menu is rotated.
         """
-        for i in range(len(self.items)):
-            item = self.items[i]
-            n = i / float(len(self.items) - 1)
-            rot = self.defaultAngle + angle + self.arc * n
-            
-            item.x = self.x + cos(rot) * self.radius
-            item.y = self.y + sin(rot) * self.radius
+        i = 0
+        for item in self.items:
+            n = int((self.offsets[i] + angle) * TRIG_SCALE) % TRIG_STEPS
+            item.x = self.x + COS_TABLE[n] * self.radius
+            item.y = self.y + SIN_TABLE[n] * self.radius
+            i += 1
     
-    def update(self):
-        if len(self.rotationSteps) > 0:
-            self.rotation = self.rotationSteps.pop(0)
+    def update(self, now=None):
+        """Move the items to where they are at time now (default
+        time.time()), the rotation finishes on time if frames are dropped"""
+        if self.rotating:
+            if now is None:
+                now = time.time()
+            elapsed = (now - self.rotationStart) / self.duration
+            if elapsed >= 1.0 or self.duration <= 0:
+                self.rotation = self.rotationTarget
+                self.rotating = False
+            else:
+                ease = EASE_TABLE[int(max(elapsed, 0.0) * (EASE_STEPS - 1))]
+                self.rotation = self.rotationFrom + (self.rotationTarget - self.rotationFrom) * ease
             self.rotate(self.rotation)
     
     def draw(self, display):
@@ -871,7 +3398,14 @@ class RotatingMenu(object):
 
 
 class MenuItem(object):
-    def __init__(self, text):
+    """Menu entry, both colours are rendered up front so (de)selecting
+    only swaps surfaces"""
+    __slots__ = ('text', 'font', 'defaultColor', 'selectedColor', 'color',
+                 'x', 'y', 'image', 'defaultImage', 'selectedImage', 'xOffset', 'yOffset')
+
+    shared_font = None  # one Font for all items, opened by the first one
+
+    def __init__(self, text, font=None):
         self.text = text
         
         self.defaultColor = (255, 255, 255)
@@ -881,66 +3415,491 @@ class MenuItem(object):
         self.x = 0
         self.y = 0  # The menu will edit these
         
-        self.font = pygame.font.Font(None, 20)
-        self.image = self.font.render(self.text, True, self.color)
-        size = self.font.size(self.text)
-        self.xOffset = size[0] / 2
-        self.yOffset = size[1] / 2
+        if font is None:
+            if MenuItem.shared_font is None:
+                MenuItem.shared_font = layout().font(20)
+            font = MenuItem.shared_font
+        self.font = font
+        self.redrawText()
     
     def select(self):
         """Just visual stuff"""
         self.color = self.selectedColor
-        self.redrawText()
+        self.image = self.selectedImage
     
     def deselect(self):
         """Just visual stuff"""
         self.color = self.defaultColor
-        self.redrawText()
+        self.image = self.defaultImage
     
     def redrawText(self):
-        self.font = pygame.font.Font(None, 20)
-        self.image = self.font.render(self.text, True, self.color)
-        size = self.font.size(self.text)
-        self.xOffset = size[0] / 2
-        self.yOffset = size[1] / 2
+        """Render both colours again, after text/font/colours changed"""
+        self.defaultImage = self.font.render(self.text, True, self.defaultColor)
+        self.selectedImage = self.font.render(self.text, True, self.selectedColor)
+        if self.color == self.selectedColor:
+            self.image = self.selectedImage
+        else:
+            self.image = self.defaultImage
+        width, height = self.font.size(self.text)
+        self.xOffset = width / 2
+        self.yOffset = height / 2
     
     def draw(self, display):
         display.blit(self.image, (self.x - self.xOffset, self.y - self.yOffset))
 
+def device_serial():
+    """Serial number of this unit for reports, the first of cpuinfo
+    Serial, DMI serial or a network MAC address that is set"""
+    for line in read_text('/proc/cpuinfo').splitlines():
+        if line.lower().startswith('serial'):
+            serial = line.split(':', 1)[-1].strip().strip('0')
+            if serial:
+                return serial
+    serial = read_text('/sys/class/dmi/id/product_serial').strip()
+    if serial:
+        return serial
+    for filename in sorted(glob.glob('/sys/class/net/*/address')):
+        address = read_text(filename).strip()
+        if address and address != '00:00:00:00:00:00':
+            return address
+    return 'unknown'
+
+
+def run_factory(clock, screen, font_time, font_text, j, tests):
+    """Runs every (name, func) test once, unattended, each stops as soon
+    as it passed, then writes the report into FACTORY_REPORT_DIR and
+    shows PASS/FAIL until a button is pressed (or FACTORY_RESULT_TIMEOUT)"""
+    global factory
+    factory = FactoryRun()
+    try:
+        for name, func in tests:
+            if func is None:
+                continue
+            factory.begin(name)
+            func(clock, screen, font_time, font_text, j)
+            factory.end()
+        report = factory.report()
+        filename = factory.write(FACTORY_REPORT_DIR, report)
+    finally:
+        factory = None
+    log.info('factory_report', file=filename, result=report['passed'] and 'PASS' or 'FAIL')
+
+    lines = [report['passed'] and 'PASS' or 'FAIL', report['device']['serial']]
+    for test in report['tests']:
+        failed = [criterion for criterion, met in test['criteria'].items() if not met]
+        if failed:
+            lines.append('%s: %s' % (test['name'], ', '.join(failed)))
+    screen.fill(report['passed'] and GREEN or RED)
+    try:
+        rendered_text = render_textrect('\n'.join(lines), font_text, screen.get_rect(), BLACK, report['passed'] and GREEN or RED, 1)
+        screen.blit(rendered_text, (0, 0))
+    except TextRectException:
+        pass  # too many failures to list, the colour says it all
+    pygame.display.flip()
+    pygame.event.clear()
+    pygame.time.set_timer(TICK_EVENT, FACTORY_RESULT_TIMEOUT)
+    while pygame.event.wait().type not in (pygame.KEYUP, pygame.QUIT, TICK_EVENT):
+        pass
+    pygame.time.set_timer(TICK_EVENT, 0)
+    return report['passed']
+
+##########################################################################
+# Session recording and replay.
+#
+# A session log holds everything from outside that HWTest code saw, in
+# the order it saw it: pygame events, time.time(), monotonic_clock(),
+# pygame.time.get_ticks(), joysticks opened and every axis and button
+# read.  Replaying feeds the same values back, so the test_* functions
+# and the doit() menu loop take the same path at the same (virtual)
+# times, without waiting for real time to pass.
+#
+# File: gzip of a JSON header line, then chunks of
+#   H stream, I payload length, payload
+# with JSON payloads for SESSION_EVENTS ([call, [[type, attributes], ...]])
+# and SESSION_JOYSTICKS (open result), array() data for the others.
+
+SESSION_VERSION = 1
+SESSION_CHUNK = struct.Struct('<HI')
+SESSION_EVENTS = 0
+SESSION_TIME = 1
+SESSION_MONOTONIC = 2
+SESSION_TICKS = 3
+SESSION_JOYSTICKS = 4
+SESSION_AXES = 5  # joystick n axis reads are stream SESSION_AXES + 2 * n
+SESSION_BUTTONS = 6  # and its button reads SESSION_BUTTONS + 2 * n
+SESSION_TYPECODES = {SESSION_TIME: 'd', SESSION_MONOTONIC: 'd', SESSION_TICKS: 'i'}
+# flags that change what the code does with the same input
+SESSION_FLAGS = ['DIRTY_RECTS', 'IDLE_WAIT', 'ANALOG_SAMPLE_RATE', 'LATENCY_MODE', 'FACTORY_MODE',
+                 'TEST_TIMEOUT', 'ESCAPE_IS_QUIT', 'CALIBRATE_SECS', 'FACTORY_EDGE', 'MIC_WAV', 'DISPLAY_RES']
+
+
+def session_typecode(stream):
+    if stream >= SESSION_AXES:
+        return (stream - SESSION_AXES) % 2 and 'b' or 'd'
+    return SESSION_TYPECODES[stream]
+
+
+class SessionTime(object):
+    """Stands in for the time module inside HWTest while a session is
+    recorded or replayed"""
+
+    def __init__(self, session, real_time):
+        self.session = session
+        self.real_time = real_time
+
+    def __getattr__(self, name):
+        return getattr(self.real_time, name)
+
+    def time(self):
+        return self.session.value(SESSION_TIME, self.real_time.time)
+
+    def sleep(self, secs):
+        self.session.sleep(secs)
+
+    def localtime(self, secs=None):
+        if secs is None:
+            secs = self.time()
+        return self.real_time.localtime(secs)
+
+    def strftime(self, format, t=None):
+        return self.real_time.strftime(format, t or self.localtime())
+
+
+class SessionJoystick(object):
+    """Joystick whose axis and button reads go through the session"""
+
+    def __init__(self, session, number, name, num_axes, num_buttons, j=None):
+        self.session = session
+        self.j = j
+        self.name = name
+        self.num_axes = num_axes
+        self.num_buttons = num_buttons
+        self.axes_stream = SESSION_AXES + 2 * number
+        self.buttons_stream = SESSION_BUTTONS + 2 * number
+
+    def init(self):
+        pass
+
+    def quit(self):
+        if self.j:
+            self.j.quit()
+
+    def get_name(self):
+        return self.name
+
+    def get_numaxes(self):
+        return self.num_axes
+
+    def get_numbuttons(self):
+        return self.num_buttons
+
+    def get_axis(self, i):
+        return self.session.value(self.axes_stream, self.j and (lambda: self.j.get_axis(i)))
+
+    def get_button(self, i):
+        return self.session.value(self.buttons_stream, self.j and (lambda: self.j.get_button(i)))
+
+
+class InputSession(object):
+    """Common part of SessionRecorder and SessionReplay, install()
+    routes HWTest's time and pygame input through the session"""
+
+    def install(self):
+        global time, _monotonic, session
+        self.saved = []
+        for module, patches in ((pygame.event, self.event_patches), (pygame.time, self.time_patches)):
+            for name, method in patches.items():
+                self.saved.append((module, name, getattr(module, name)))
+                setattr(module, name, getattr(self, method))
+        self.real_time = time
+        time = SessionTime(self, self.real_time)
+        self.real_monotonic = real_monotonic_clock()
+        self.saved_monotonic = _monotonic
+        _monotonic = self.monotonic
+        session = self
+
+    def uninstall(self):
+        global time, _monotonic, session
+        for module, name, function in self.saved:
+            setattr(module, name, function)
+        time = self.real_time
+        _monotonic = self.saved_monotonic
+        session = None
+
+    def monotonic(self):
+        return self.value(SESSION_MONOTONIC, self.real_monotonic)
+
+    def get_ticks(self):
+        return self.value(SESSION_TICKS, self.saved_function(pygame.time, 'get_ticks'))
+
+    def saved_function(self, module, name):
+        for saved_module, saved_name, function in self.saved:
+            if saved_module is module and saved_name == name:
+                return function
+
+
+class SessionRecorder(InputSession):
+    """Records a session log while HWTest runs normally"""
+    # pygame function -> method replacing it
+    event_patches = {'get': 'get', 'wait': 'wait', 'poll': 'poll'}
+    time_patches = {'get_ticks': 'get_ticks'}
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread = threading.current_thread()  # only its reads are recorded
+        self.pending = {}  # stream -> array of values not written yet
+        self.flushed = 0
+        self.f = gzip.open(filename, 'wb')
+        header = {
+            'version': SESSION_VERSION,
+            'byteorder': sys.byteorder,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'profile': system_profile()['name'],
+            'flags': dict([(name, globals()[name]) for name in SESSION_FLAGS]),
+        }
+        self.f.write(json.dumps(header) + '\n')
+
+    def value(self, stream, read):
+        value = read()
+        if threading.current_thread() is self.thread:
+            try:
+                self.pending[stream].append(value)
+            except KeyError:
+                self.pending[stream] = array(session_typecode(stream), [value])
+        return value
+
+    def sleep(self, secs):
+        self.real_time.sleep(secs)
+
+    def write(self, stream, payload):
+        self.f.write(SESSION_CHUNK.pack(stream, len(payload)))
+        self.f.write(payload)
+
+    def write_pending(self):
+        for stream, values in self.pending.items():
+            self.write(stream, values.tostring())
+        self.pending.clear()
+
+    def events(self, call, events):
+        """Log events returned by pygame.event.call(), with the reads
+        made before it"""
+        self.write_pending()
+        self.write(SESSION_EVENTS, json.dumps([call, [[event.type, event.dict] for event in events]], default=repr))
+        now = self.real_time.time()
+        if now - self.flushed >= 1:
+            self.f.flush()  # a crash loses at most a second
+            self.flushed = now
+        return events
+
+    def get(self, *args):
+        return self.events('get', self.saved_function(pygame.event, 'get')(*args))
+
+    def wait(self):
+        return self.events('wait', [self.saved_function(pygame.event, 'wait')()])[0]
+
+    def poll(self):
+        return self.events('poll', [self.saved_function(pygame.event, 'poll')()])[0]
+
+    def joystick(self, number, evdev):
+        j = _open_joystick(number, evdev)
+        if j is None:
+            opened = None
+        else:
+            opened = [j.get_name(), j.get_numaxes(), j.get_numbuttons()]
+        self.write(SESSION_JOYSTICKS, json.dumps([number, opened]))
+        if j is None:
+            return None
+        return SessionJoystick(self, number, j=j, *opened)
+
+    def close(self):
+        self.write_pending()
+        self.f.close()
+
+
+class SessionReplay(InputSession):
+    """Feeds a recorded session log back, nothing waits for real time"""
+    event_patches = {'get': 'get', 'wait': 'wait', 'poll': 'poll', 'pump': 'ignore', 'clear': 'ignore', 'post': 'ignore'}
+    time_patches = {'get_ticks': 'get_ticks', 'wait': 'delay', 'delay': 'delay', 'set_timer': 'ignore', 'Clock': 'Clock'}
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread = threading.current_thread()  # other threads get real values
+        self.streams = {}
+        self.positions = {}
+        self.last = {}  # stream -> last value, for reads past the end
+        self.slept = 0.0  # virtual seconds slept since the last recorded time read
+        self.events_left = deque()
+        self.joysticks = deque()
+        self.diverged = False
+        f = gzip.open(filename, 'rb')
+        try:
+            self.header = json.loads(f.readline())
+            byteswap = self.header['byteorder'] != sys.byteorder
+            while True:
+                chunk = f.read(SESSION_CHUNK.size)
+                if len(chunk) < SESSION_CHUNK.size:
+                    break
+                stream, length = SESSION_CHUNK.unpack(chunk)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                if stream == SESSION_EVENTS:
+                    self.events_left.append(json.loads(payload))
+                elif stream == SESSION_JOYSTICKS:
+                    self.joysticks.append(json.loads(payload))
+                else:
+                    values = array(session_typecode(stream))
+                    values.fromstring(payload)
+                    if byteswap:
+                        values.byteswap()
+                    self.streams.setdefault(stream, array(values.typecode)).extend(values)
+        except (IOError, EOFError, struct.error):
+            log.warning('session_truncated', file=filename)
+        finally:
+            f.close()
+
+    def apply_flags(self):
+        """Set the flags and device profile the session was recorded with"""
+        global _profile
+        for name, value in self.header['flags'].items():
+            if name in SESSION_FLAGS:
+                globals()[name] = value
+        for profile in load_profiles():
+            if profile['name'] == self.header['profile']:
+                _profile = profile
+
+    def value(self, stream, read):
+        if threading.current_thread() is not self.thread:
+            return read and read()
+        position = self.positions.get(stream, 0)
+        values = self.streams.get(stream)
+        if values is not None and position < len(values):
+            self.positions[stream] = position + 1
+            value = self.last[stream] = values[position]
+            if stream == SESSION_TIME:
+                self.slept = 0.0
+            return value
+        # past the end of the recording, carry on from the last value
+        self.mismatch('read past the end of stream %d' % stream)
+        value = self.last.get(stream, 0)
+        if stream in (SESSION_TIME, SESSION_MONOTONIC):
+            return value + self.slept
+        if stream == SESSION_TICKS:
+            return value + int(self.slept * 1000)
+        return value
+
+    def mismatch(self, text):
+        if not self.diverged and self.events_left:
+            log.warning('replay_diverged', file=self.filename, reason=text)
+        self.diverged = True
+
+    def sleep(self, secs):
+        self.slept += secs
+
+    def events(self, call):
+        if not self.events_left:
+            return [pygame.event.Event(pygame.QUIT)]  # end of the recording
+        recorded_call, events = self.events_left.popleft()
+        if recorded_call != call:
+            self.mismatch('%s called where %s was recorded' % (call, recorded_call))
+        result = []
+        for event_type, attributes in events:
+            result.append(pygame.event.Event(event_type, dict([(str(name), value) for name, value in attributes.items()])))
+        return result
+
+    def get(self, *args):
+        return self.events('get')
+
+    def wait(self):
+        events = self.events('wait')
+        return events and events[0] or pygame.event.Event(pygame.NOEVENT)
+
+    def poll(self):
+        events = self.events('poll')
+        return events and events[0] or pygame.event.Event(pygame.NOEVENT)
+
+    def ignore(self, *args):
+        """pump(), clear(), post() (posted events are in the recording)
+        and set_timer() do nothing"""
+        pass
+
+    def delay(self, ms):
+        self.slept += ms / 1000.0
+        return ms
+
+    def Clock(self):
+        return ReplayClock()
+
+    def joystick(self, number, evdev):
+        if not self.joysticks:
+            self.mismatch('joystick %d opened, not recorded' % number)
+            return None
+        recorded_number, opened = self.joysticks.popleft()
+        if opened is None:
+            return None
+        return SessionJoystick(self, recorded_number, *opened)
+
+    def close(self):
+        if self.events_left:
+            self.mismatch('%d event fetches not replayed' % len(self.events_left))
+        times = self.streams.get(SESSION_TIME)
+        if times:
+            log.info('replayed', file=self.filename, recorded_secs=times[-1] - times[0], diverged=self.diverged)
+
+
+class ReplayClock(object):
+    """pygame.time.Clock that never waits"""
+
+    def tick(self, framerate=0):
+        return 0
+
+    def get_fps(self):
+        return 0.0
+
+
+session = None  # SessionRecorder or SessionReplay while installed
+
 ##########################################################################
 
 
+def display_resolution(profile):
+    """Size to open the display at: DISPLAY_RES when set, else the
+    display's own mode on a framebuffer (the handhelds), the profile's
+    resolution in a desktop window.  Needs pygame.display.init()."""
+    if DISPLAY_RES:
+        return tuple(DISPLAY_RES)
+    if pygame.display.get_driver() not in WINDOWED_DRIVERS:
+        info = pygame.display.Info()
+        if info.current_w > 0 and info.current_h > 0:
+            return info.current_w, info.current_h
+    return profile['resolution']
+
+
 def doit(do_sound_test=False):
-    window_res = (480, 272)  # FIXME use device res?
+    startup.mark('python+imports')
+    profile = system_profile()
+    startup.mark('profile')
     
-    pygame.mixer.init()
-    for x in sound_buttons:
-        sound_buttons[x] = pygame.mixer.Sound(sound_buttons[x])
-
-    pygame.init()
+    # pygame.init() without the mixer, audio is only opened (and sounds
+    # loaded) when the Sound test is first used, see get_sound()
+    # The joystick is opened when the first test starts, see open_joystick()
+    pygame.display.init()
+    pygame.font.init()
+    pygame.time.wait(0)  # starts SDL's timer, pygame.time.get_ticks() is 0 without it
+    startup.mark('pygame init')
 
     # set up the screen/window
-    screen = pygame.display.set_mode(window_res)
+    window_res = display_resolution(profile)
+    screen = pygame.display.set_mode(window_res, 0, DISPLAY_DEPTH)
     pygame.mouse.set_visible(False)
     pygame.display.set_caption("Hardware Test")
     my_rect = screen.get_rect()
     width = my_rect.width
     height = my_rect.height
+    startup.mark('display')
 
-    # set up fonts
-    font_text = pygame.font.SysFont(None, 20)
-    font_time = pygame.font.SysFont(None, 40)
-    
     clock = pygame.time.Clock()
 
-    try:
-        j = pygame.joystick.Joystick(0)
-        j.init()
-        print 'Initialized Joystick : %s' % j.get_name()
-    except pygame.error:
-        j = None
-    
-
     #######################
     fps_limit = 90
     menu_mapping = [
@@ -948,67 +3907,195 @@ def doit(do_sound_test=False):
         ('Analog test', test_analog1),
         ('gsensor test', test_analog2),
         ('Sound test', test_sound),
-        #('Mic test', test_mic),
+        ('Display test', test_display),
+        ('Mic test', test_mic),
         ('Exit', None),
     ]
-    menu = RotatingMenu(x=width / 2, y=height / 2, radius=(min(width, height) / 2) - 20, arc=pi, defaultAngle=pi / 2.0, wrap=True)
+    if 'gsensor' not in profile['sensors']:
+        menu_mapping.remove(('gsensor test', test_analog2))
+    if 'mic' not in profile['sensors'] and not MIC_WAV:
+        menu_mapping.remove(('Mic test', test_mic))
+    menu = RotatingMenu(x=width / 2, y=height / 2, radius=(min(width, height) / 2) - layout().pixels(20), arc=pi, defaultAngle=pi / 2.0, wrap=True)
     
     for i, menu_entry in enumerate(menu_mapping):
         menu.addItem(MenuItem(menu_entry[0]))
     menu.selectItem(0)
+    startup.mark('menu')
+
+    # everything else waits until the menu is on screen
+    first_frame = True
+    font_text = font_time = None
+    j = evdev = None
+    
+    if FACTORY_MODE:
+        # no menu, straight into every test
+        first_frame = False
+        font_text, font_time = open_fonts()
+        if EVDEV_INPUT:
+            evdev = EvdevReader()
+            evdev.start()
+        j = open_joystick(0, evdev)
+        try:
+            passed = run_factory(clock, screen, font_time, font_text, j, menu_mapping)
+        finally:
+            if j:
+                j.quit()
+            if evdev:
+                evdev.stop()
+        return passed
     
     #test_buttons(clock, screen, font_time, font_text)
     
     # Loop
-    while True:
-        # Handle events
-        events = pygame.event.get()
-        for event in events:
-            if event.type == pygame.QUIT:
-                return False
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
+    scheduler = FrameScheduler(clock, fps_limit)
+    profiler.start('menu')
+    try:
+        while True:
+            # Handle events, full frame rate only while the menu rotates
+            events = scheduler.events(active=menu.rotating)
+            for event in events:
+                if event.type == pygame.QUIT:
                     return False
-                elif event.key in [pygame.K_LEFT, pygame.K_UP]:
-                    menu.selectItem(menu.selectedItemNumber + 1)
-                elif event.key in [pygame.K_RIGHT, pygame.K_DOWN]:
-                    menu.selectItem(menu.selectedItemNumber - 1)
-            elif event.type == pygame.KEYUP:
-                if event.key in [pygame.K_LEFT, pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_ESCAPE]:
-                    pass
-                else:
-                    menu_func = menu_mapping[menu.selectedItemNumber][1]
-                    if menu_func:
-                        menu_func(clock, screen, font_time, font_text, j)
+                elif event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        return False
+                    elif event.key in [pygame.K_LEFT, pygame.K_UP]:
                         menu.selectItem(menu.selectedItemNumber + 1)
+                    elif event.key in [pygame.K_RIGHT, pygame.K_DOWN]:
+                        menu.selectItem(menu.selectedItemNumber - 1)
+                elif event.type == pygame.KEYUP:
+                    if event.key in [pygame.K_LEFT, pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_ESCAPE]:
+                        pass
                     else:
-                        return False  # Quit
+                        menu_func = menu_mapping[menu.selectedItemNumber][1]
+                        if menu_func:
+                            if font_text is None:
+                                # set up fonts
+                                began = time.time()
+                                font_text, font_time = open_fonts()
+                                startup.mark('fonts', began)
+                                j = open_joystick(0, evdev)
+                                startup.mark('joystick')
+                            menu_func(clock, screen, font_time, font_text, j)
+                            menu.selectItem(menu.selectedItemNumber + 1)
+                            profiler.start('menu')
+                        else:
+                            return False  # Quit
         
-        # Update stuff
-        menu.update()
+            # Update stuff
+            menu.update()
+            profiler.mark('update')
         
-        # Draw stuff
-        screen.fill((0, 0, 0))
-        menu.draw(screen)
-        pygame.display.flip()  # Show the updated scene
-        clock.tick(fps_limit)
-    
-    if j:
-        j.quit()
+            # Draw stuff
+            screen.fill((0, 0, 0))
+            menu.draw(screen)
+            profiler.draw(screen)
+            profiler.mark('blit')
+            pygame.display.flip()  # Show the updated scene
+            profiler.mark('flip')
+            profiler.end_frame()
+            if first_frame:
+                first_frame = False
+                startup.mark('first frame')
+                # decode screen backgrounds while the operator looks at the menu
+                assets.preload([filename for filename in ('wallpaper.png', profile['background']) if filename])
+                if EVDEV_INPUT:
+                    evdev = EvdevReader()
+                    evdev.start()
+                    startup.mark('evdev')
+    finally:
+        if j:
+            j.quit()
+        if evdev:
+            evdev.stop()
 
     #pygame.image.save(screen, "screenshot.png")
 
 
 def main(argv=None):
+    global LATENCY_MODE, EVDEV_INPUT, RECORD_DIR, FACTORY_MODE, FACTORY_REPORT_DIR, DISPLAY_DEPTH, PROFILE_OVERLAY, MIC_WAV, DISPLAY_RES
     if argv is None:
         argv = sys.argv
     
-    if len(argv) >= 2:
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--latency', action='store_true', help='measure button to display latency in the button test, written to ' + LATENCY_FILE)
+    parser.add_option('--evdev', action='store_true', help='read buttons and sticks from /dev/input/event* directly instead of through SDL')
+    parser.add_option('--record', metavar='DIR', help='record every joystick sample in the analog tests to a capture file in DIR')
+    parser.add_option('--factory', action='store_true', help='run every test unattended, each until it passes, and write a JSON report, exit code 1 unless every test passed')
+    parser.add_option('--report-dir', metavar='DIR', default=FACTORY_REPORT_DIR, help='directory for --factory reports (default %default)')
+    parser.add_option('--record-session', metavar='FILE', help='record all input and clock reads to FILE, for --replay')
+    parser.add_option('--replay', metavar='FILE', help='replay a --record-session FILE instead of reading input, as fast as possible')
+    parser.add_option('--headless', action='store_true', help='no display or sound output, e.g. to --replay sessions in bulk')
+    parser.add_option('--profile', action='store_true', help='time every frame phase, written to ' + PROFILE_FILE)
+    parser.add_option('--fps', action='store_true', help='show fps, frame time and worst frame time on screen')
+    parser.add_option('--mic-wav', metavar='FILE', help='use WAV FILE as the microphone, and show the Mic test')
+    parser.add_option('--check-loopback', nargs=2, metavar='PLAYED RECORDED', help='analyse a speaker check WAV pair saved with --record, exit code 1 unless every channel is OK')
+    parser.add_option('--resolution', metavar='WxH', help='open the display at this size instead of its own (or the profile\'s in a window)')
+    parser.add_option('--display-benchmark', action='store_true', help='log fill, copy, blit and flip speed of the display and exit')
+    parser.add_option('--log', metavar='FILE', default=LOG_FILE, help='append the log to FILE, rotated at %d KiB, instead of stdout' % (LOG_MAX_BYTES / 1024))
+    options, args = parser.parse_args(argv[1:])
+    FACTORY_MODE = options.factory
+    FACTORY_REPORT_DIR = options.report_dir
+    LATENCY_MODE = options.latency
+    EVDEV_INPUT = options.evdev
+    RECORD_DIR = options.record
+    MIC_WAV = options.mic_wav
+    if options.resolution:
+        try:
+            DISPLAY_RES = tuple([int(length) for length in options.resolution.lower().split('x')])
+        except ValueError:
+            DISPLAY_RES = ()
+        if len(DISPLAY_RES) != 2:
+            parser.error('--resolution wants WIDTHxHEIGHT, e.g. 320x240')
+    if options.log:
+        log.open(options.log)
+    if options.check_loopback:
+        results = check_loopback_files(*options.check_loopback)
+        log_loopback(results)
+        if [result for result in results if loopback_verdict(result) != 'OK']:
+            return 1
+        return 0
+
+    PROFILE_OVERLAY = options.fps
+    if options.profile:
+        profiler.export(PROFILE_FILE)
+    elif options.fps:
+        profiler.enable()
+    if options.headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+        DISPLAY_DEPTH = 16
+    if options.display_benchmark:
+        pygame.display.init()
+        screen = pygame.display.set_mode(display_resolution(system_profile()), 0, DISPLAY_DEPTH)
+        log_display_benchmark(screen, display_benchmark(screen))
+        pygame.display.quit()
+        return 0
+
+    if len(args) >= 1:
         do_sound_test = True
     else:
         do_sound_test = False
-    doit(do_sound_test=do_sound_test)
+    input_session = None
+    if options.replay:
+        input_session = SessionReplay(options.replay)
+        input_session.apply_flags()
+        EVDEV_INPUT = False  # events it posted are in the recording
+        RECORD_DIR = None
+    elif options.record_session:
+        input_session = SessionRecorder(options.record_session)
+    if input_session:
+        input_session.install()
+    try:
+        passed = doit(do_sound_test=do_sound_test)
+    finally:
+        if input_session:
+            input_session.uninstall()
+            input_session.close()
+        profiler.close()
     
+    if FACTORY_MODE and not passed:
+        return 1
     return 0
 
 
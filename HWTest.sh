@@ -8,5 +8,5 @@ export PATH=$PATH:$HOME/local/python/usr/bin
 
 cd "$(dirname "$0")"
 
-python hardware_test.py >> $HOME/log
+python hardware_test.py --log $HOME/log 2>> $HOME/log.err
 
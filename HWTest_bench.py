@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+# HWTest_bench - headless frame cost benchmarks for HWTest
+"""Frame cost benchmarks for the HWTest screens.
+
+Runs every test screen and the main menu loop under SDL's dummy
+video/audio drivers, fed by a synthetic event stream and a fake
+joystick, so numbers can be compared on a desktop box before builds are
+pushed to the handhelds.
+
+    python HWTest_bench.py [--frames N] [--save FILE] [--compare FILE]
+
+With --compare the exit code is 1 when any screen got slower than the
+saved results by more than --tolerance.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+from math import sin, cos
+from optparse import OptionParser
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+import HWTest
+
+
+window_res = (480, 272)
+window_depth = 16  # RGB565 like the handhelds, dummy driver defaults to 8 bit
+
+
+class BenchClock(object):
+    """Stand in for pygame.time.Clock that never sleeps.
+
+    Records how long each frame took (the time between tick() calls)
+    and how many GC tracked objects it left behind, feeds the scripted
+    events and posts pygame.QUIT once the requested number of frames ran.
+    """
+
+    def __init__(self, frames, events=None, joystick=None):
+        self.frames = frames
+        self.events = events or {}  # frame number -> list of events to post
+        self.joystick = joystick
+        self.count = 0
+        self.times = []
+        self.allocs = []
+        self.last = None
+        self.last_objects = None
+
+    def tick(self, framerate=0):
+        now = time.time()
+        objects = gc.get_count()[0]
+        if self.last is not None:
+            self.times.append(now - self.last)
+            self.allocs.append(objects - self.last_objects)
+        for event in self.events.get(self.count, []):
+            pygame.event.post(event)
+        if self.joystick:
+            self.joystick.step()
+        self.count += 1
+        if self.count > self.frames:
+            pygame.event.post(pygame.event.Event(pygame.QUIT))
+        self.last_objects = gc.get_count()[0]
+        self.last = time.time()
+        return 0
+
+    def get_fps(self):
+        return 0.0
+
+
+class FakeJoystick(object):
+    """pygame.joystick.Joystick stand in, moves the stick round a circle
+    and presses its buttons in turn, one step per frame."""
+
+    def __init__(self, numaxes=2, numbuttons=0, name='Bench joystick'):
+        self.numaxes = numaxes
+        self.numbuttons = numbuttons
+        self.name = name
+        self.frame = 0
+
+    def step(self):
+        self.frame += 1
+
+    def init(self):
+        pass
+
+    def quit(self):
+        pass
+
+    def get_name(self):
+        return self.name
+
+    def get_numaxes(self):
+        return self.numaxes
+
+    def get_numbuttons(self):
+        return self.numbuttons
+
+    def get_axis(self, i):
+        angle = self.frame / 20.0 + i
+        if i % 2:
+            return sin(angle)
+        return cos(angle)
+
+    def get_button(self, i):
+        return int((self.frame / 10) % max(self.numbuttons, 1) == i)
+
+
+def key_presses(frames, keys, every=30):
+    """Press and release keys in turn, one every `every` frames"""
+    events = {}
+    for n, frame in enumerate(range(every, frames, every)):
+        key = keys[n % len(keys)]
+        events[frame] = [pygame.event.Event(pygame.KEYDOWN, key=key)]
+        events[frame + every / 2] = [pygame.event.Event(pygame.KEYUP, key=key)]
+    return events
+
+
+def percentile(values, pct):
+    """values must be sorted"""
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run_screen(func, args, frames, events=None, joystick=None):
+    """Run func(clock, *args) for frames frames, returns a dict of stats"""
+    pygame.event.clear()
+    HWTest.text_cache.clear()
+    clock = BenchClock(frames, events, joystick)
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()  # so the allocation counter is not reset mid frame
+    cpu_start = sum(os.times()[:2])
+    wall_start = time.time()
+    try:
+        func(clock, *args)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    wall = time.time() - wall_start
+    cpu = sum(os.times()[:2]) - cpu_start
+
+    times = sorted(clock.times)
+    return {
+        'frames': len(times),
+        'mean_ms': sum(times) / len(times) * 1000,
+        'p50_ms': percentile(times, 50) * 1000,
+        'p90_ms': percentile(times, 90) * 1000,
+        'p99_ms': percentile(times, 99) * 1000,
+        'max_ms': times[-1] * 1000,
+        'allocs_per_frame': float(sum(clock.allocs)) / len(clock.allocs),
+        'cpu_s': cpu,
+        'wall_s': wall,
+        'text_cache_hit_rate': HWTest.text_cache.hit_rate(),
+    }
+
+
+def report(label, stats):
+    print '%-20s p50 %7.3f  p90 %7.3f  p99 %7.3f  max %7.3f ms  %6.1f objs/frame  cpu %5.2f s  text cache %5.1f%%' % (
+        label, stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['max_ms'],
+        stats['allocs_per_frame'], stats['cpu_s'], stats['text_cache_hit_rate'] * 100)
+
+
+def bench_screens(screen, font_time, font_text, frames):
+    """Returns list of (name, stats) for every test screen"""
+    results = []
+    args = (screen, font_time, font_text)
+    test_buttons = HWTest.system_profile()['test_buttons'].keys()
+    analog_keys = [HWTest.BTN_A, HWTest.BTN_B]
+
+    saved = HWTest.DIRTY_RECTS
+    try:
+        for dirty in (False, True):
+            HWTest.DIRTY_RECTS = dirty
+            joystick = FakeJoystick()
+            stats = run_screen(HWTest.test_buttons, args + (joystick,), frames, key_presses(frames, test_buttons), joystick)
+            results.append(('test_buttons %s' % (dirty and 'dirty' or 'full'), stats))
+    finally:
+        HWTest.DIRTY_RECTS = saved
+
+    joystick = FakeJoystick()
+    results.append(('test_analog1', run_screen(HWTest.test_analog1, args + (joystick,), frames, key_presses(frames, analog_keys), joystick)))
+
+    # test_analog2 opens joystick #1 itself, generic (many axes) layout
+    joystick = FakeJoystick(numaxes=3, numbuttons=4, name='Bench gsensor')
+    real_joystick = pygame.joystick.Joystick
+    pygame.joystick.Joystick = lambda n: joystick
+    try:
+        results.append(('test_analog2', run_screen(HWTest.test_analog2, args + (None,), frames, key_presses(frames, analog_keys), joystick)))
+    finally:
+        pygame.joystick.Joystick = real_joystick
+
+    results.append(('test_sound', run_screen(HWTest.test_sound, args + (None,), frames, key_presses(frames, HWTest.sound_buttons.keys()))))
+    return results
+
+
+def bench_menu(frames):
+    """Main menu loop in doit(), rotating the menu back and forth"""
+    keys = [pygame.K_LEFT, pygame.K_LEFT, pygame.K_RIGHT]
+
+    def run(bench_clock):
+        real_clock = pygame.time.Clock
+        pygame.time.Clock = lambda: bench_clock
+        try:
+            HWTest.doit()
+        finally:
+            pygame.time.Clock = real_clock
+    return run_screen(run, (), frames, key_presses(frames, keys, every=60))
+
+
+def menu_animation(clock, screen, fps=60):
+    """RotatingMenu update and draw only, on a virtual clock advancing
+    1/fps per frame, a new item selected every half rotation so the menu
+    never stops moving."""
+    width, height = screen.get_size()
+    menu = HWTest.RotatingMenu(x=width / 2, y=height / 2, radius=(min(width, height) / 2) - 20, arc=HWTest.pi, defaultAngle=HWTest.pi / 2.0, wrap=True)
+    for text in ('Button test', 'Analog test', 'gsensor test', 'Sound test', 'Exit'):
+        menu.addItem(HWTest.MenuItem(text))
+    now = 0.0
+    menu.selectItem(0, now)
+    step = int(menu.duration * fps / 2)
+    frame = 0
+    while not pygame.event.peek(pygame.QUIT):
+        frame += 1
+        now += 1.0 / fps
+        if frame % step == 0:
+            menu.selectItem(menu.selectedItemNumber + 1, now)
+        menu.update(now)
+        screen.fill((0, 0, 0))
+        menu.draw(screen)
+        clock.tick(fps)
+    pygame.event.clear()
+
+
+def compare(results, baseline, tolerance, min_delta_ms=0.1):
+    """Returns list of screens slower than baseline by more than tolerance,
+    differences under min_delta_ms are timer noise and ignored."""
+    slower = []
+    for name, stats in results:
+        old = baseline.get(name)
+        if not old:
+            continue
+        for key in ('p50_ms', 'p90_ms'):
+            if stats[key] - old[key] > max(old[key] * tolerance, min_delta_ms):
+                slower.append('%s %s %.3f -> %.3f' % (name, key, old[key], stats[key]))
+    return slower
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--frames', type='int', default=600, help='frames per screen (default %default)')
+    parser.add_option('--save', metavar='FILE', help='write results as JSON')
+    parser.add_option('--compare', metavar='FILE', help='fail if slower than results saved in FILE')
+    parser.add_option('--tolerance', type='float', default=0.5, help='allowed slow down for --compare (default %default)')
+    options, args = parser.parse_args(argv[1:])
+
+    HWTest.IDLE_WAIT = False  # BenchClock drives the frames, never block
+    HWTest.ANALOG_SAMPLE_RATE = 0  # nor sample until a frame deadline
+    HWTest.DISPLAY_DEPTH = window_depth  # for doit()
+
+    pygame.init()
+    screen = pygame.display.set_mode(window_res, 0, window_depth)
+    font_text = pygame.font.SysFont(None, 20)
+    font_time = pygame.font.SysFont(None, 40)
+
+    results = bench_screens(screen, font_time, font_text, options.frames)
+    results.append(('menu', bench_menu(options.frames)))
+    results.append(('menu animation', run_screen(menu_animation, (screen,), options.frames)))
+    for name, stats in results:
+        report(name, stats)
+
+    pygame.quit()
+
+    if options.save:
+        f = open(options.save, 'w')
+        json.dump(dict(results), f, indent=4, sort_keys=True)
+        f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        baseline = json.load(f)
+        f.close()
+        slower = compare(results, baseline, options.tolerance)
+        for line in slower:
+            print 'REGRESSION', line
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())